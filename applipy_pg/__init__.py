@@ -1,9 +1,22 @@
 from .connections import (
+    DeadlineExceededError,
+    HealthPolicy,
+    HealthStats,
+    PgBufferedWriter,
     PgConnection,
     PgModule,
     PgPool,
+    PgPoolRegistry,
+    PgRecordingPool,
+    PgReplayPool,
+    PgStatementsCollector,
+    StatementStats,
+    UnrecordedQueryError,
+    deadline,
+    scoped_settings,
 )
 from .migrations import (
+    PgBackgroundMigration,
     PgClassNameMigration,
     PgMigration,
     PgMigrationsModule,
@@ -11,10 +24,23 @@ from .migrations import (
 
 
 __all__ = [
+    "DeadlineExceededError",
+    "HealthPolicy",
+    "HealthStats",
+    "PgBackgroundMigration",
+    "PgBufferedWriter",
     "PgClassNameMigration",
     "PgConnection",
     "PgMigration",
     "PgMigrationsModule",
     "PgModule",
     "PgPool",
+    "PgPoolRegistry",
+    "PgRecordingPool",
+    "PgReplayPool",
+    "PgStatementsCollector",
+    "StatementStats",
+    "UnrecordedQueryError",
+    "deadline",
+    "scoped_settings",
 ]
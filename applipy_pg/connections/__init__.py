@@ -1,10 +1,42 @@
 from .connection import PgConnection
+from .deadline import (
+    DeadlineExceededError,
+    deadline,
+)
+from .health import (
+    HealthPolicy,
+    HealthStats,
+)
 from .module import PgModule
 from .pool_handle import PgPool
+from .registry import PgPoolRegistry
+from .replay import (
+    PgRecordingPool,
+    PgReplayPool,
+    UnrecordedQueryError,
+)
+from .settings import scoped_settings
+from .statements import (
+    PgStatementsCollector,
+    StatementStats,
+)
+from .writer import PgBufferedWriter
 
 
 __all__ = [
+    "DeadlineExceededError",
+    "HealthPolicy",
+    "HealthStats",
+    "PgBufferedWriter",
     "PgConnection",
     "PgModule",
     "PgPool",
+    "PgPoolRegistry",
+    "PgRecordingPool",
+    "PgReplayPool",
+    "PgStatementsCollector",
+    "StatementStats",
+    "UnrecordedQueryError",
+    "deadline",
+    "scoped_settings",
 ]
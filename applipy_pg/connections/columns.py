@@ -0,0 +1,107 @@
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Mapping,
+    Sequence,
+)
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+_INITIAL_CAPACITY = 1024
+
+# Default dtypes by PostgreSQL type OID, for columns without an explicit dtype
+_DTYPES_BY_TYPE_OID = {
+    16: "bool",  # bool
+    20: "int64",  # int8
+    21: "int16",  # int2
+    23: "int32",  # int4
+    700: "float32",  # float4
+    701: "float64",  # float8
+    1082: "datetime64[D]",  # date
+    1114: "datetime64[us]",  # timestamp
+}
+
+
+def _import_numpy() -> Any:
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError(
+            "NumPy is required to fetch columns. Install it with `pip install applipy_pg[numpy]`"
+        ) from e
+    return numpy
+
+
+class ColumnsBuilder:
+    """
+    Accumulates batches of rows into one growable array per column, with a
+    mask marking NULL values.
+    """
+
+    def __init__(
+        self, column_names: Sequence[str], column_dtypes: Sequence[Any]
+    ) -> None:
+        self._np = _import_numpy()
+        self._column_names = list(column_names)
+        self._data = [
+            self._np.empty(_INITIAL_CAPACITY, dtype=dtype) for dtype in column_dtypes
+        ]
+        self._masks = [
+            self._np.zeros(_INITIAL_CAPACITY, dtype=bool) for _ in column_names
+        ]
+        self._size = 0
+
+    @classmethod
+    def from_description(
+        cls, description: Sequence[Any], dtypes: Mapping[str, Any] | None
+    ) -> "ColumnsBuilder":
+        dtypes = dtypes or {}
+        column_names = [column.name for column in description]
+        column_dtypes = [
+            dtypes.get(column.name, _DTYPES_BY_TYPE_OID.get(column.type_code, "object"))
+            for column in description
+        ]
+        return cls(column_names, column_dtypes)
+
+    def append(self, rows: Sequence[Sequence[Any]]) -> None:
+        if not rows:
+            return
+        start = self._size
+        end = start + len(rows)
+        self._ensure_capacity(end)
+        for data, mask, values in zip(self._data, self._masks, zip(*rows)):
+            nulls = [value is None for value in values]
+            if any(nulls):
+                mask[start:end] = nulls
+                if data.dtype.kind != "O":
+                    # Masked anyway, but datetimes are filled with NaT rather
+                    # than the epoch, so that unmasked data is not plausible
+                    if data.dtype.kind == "M":
+                        fill = self._np.array("NaT", dtype=data.dtype)[()]
+                    else:
+                        fill = self._np.zeros((), dtype=data.dtype)[()]
+                    values = tuple(fill if value is None else value for value in values)
+            data[start:end] = values
+        self._size = end
+
+    def build(self) -> dict[str, "np.ma.MaskedArray[Any, Any]"]:
+        return {
+            name: self._np.ma.MaskedArray(data[:self._size], mask=mask[:self._size])
+            for name, data, mask in zip(self._column_names, self._data, self._masks)
+        }
+
+    def _ensure_capacity(self, size: int) -> None:
+        capacity = len(self._masks[0]) if self._masks else size
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        self._data = [self._resize(data, capacity) for data in self._data]
+        self._masks = [self._resize(mask, capacity) for mask in self._masks]
+
+    def _resize(self, array: "np.ndarray[Any, Any]", capacity: int) -> "np.ndarray[Any, Any]":
+        resized: "np.ndarray[Any, Any]" = self._np.zeros(capacity, dtype=array.dtype)
+        resized[:self._size] = array[:self._size]
+        return resized
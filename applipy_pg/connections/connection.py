@@ -1,19 +1,128 @@
 from typing import Any
 
+from psycopg2.extensions import make_dsn
+
+from .health import HealthPolicy
+from .settings import (
+    format_setting_value,
+    validate_setting_name,
+)
+
+
+_SSL_MODES = ("disable", "allow", "prefer", "require", "verify-ca", "verify-full")
+PGBOUNCER_TRANSACTION_POOLER = "pgbouncer-transaction"
+_POOLERS = (PGBOUNCER_TRANSACTION_POOLER,)
+
+
+def _validate_non_negative_int(name: str, value: int | None) -> None:
+    if value is None:
+        return
+    if type(value) is not int:
+        raise TypeError(f"Connection parameter `{name}` must be an integer or None")
+    if value < 0:
+        raise ValueError(f"Connection parameter `{name}` must be non-negative")
+
+
+def _escape_option_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace(" ", "\\ ")
+
 
 class PgConnection:
+    """
+    Connection parameters of a PostgreSQL database.
+
+    Besides the basic parameters, it exposes the libpq parameters that tune
+    how the connection is established and how dead peers are detected:
+
+    - `connect_timeout`: seconds to wait while connecting
+    - `keepalives`: whether TCP keepalives are used (enabled by default in libpq)
+    - `keepalives_idle`, `keepalives_interval`, `keepalives_count`: TCP
+      keepalive tuning
+    - `tcp_user_timeout`: milliseconds transmitted data may remain
+      unacknowledged before the connection is closed
+    - `sslmode`: one of `disable`, `allow`, `prefer`, `require`, `verify-ca`
+      or `verify-full`
+
+    To connect through a Unix socket, set `host` to the directory containing
+    the socket file. If `host` is omitted, libpq's default socket directory is
+    used.
+
+    Set `pooler` to `pgbouncer-transaction` when connecting through PgBouncer
+    in transaction pooling mode, so that `PgPool` refuses features bound to a
+    server session.
+
+    `session` contains server settings (i.e. `statement_timeout`, `work_mem`,
+    `search_path`) that are sent in the `options` connection parameter, so
+    they are applied once when each physical connection is opened and survive
+    `RESET ALL`. PgBouncer does not accept `options`, so with the
+    `pgbouncer-transaction` pooler the session settings are instead applied
+    transaction-locally on every `PgPool.cursor()` block.
+
+    `types` lists custom composite and enum types (optionally qualified by
+    schema) for which `PgPool` registers typecasters on every connection, so
+    that composites are returned as named tuples and arrays of enums as lists.
+
+    `event_loops` is the number of event loops the pool is used from, when
+    running several of them in different threads. `PgPool` creates a pool per
+    event loop, and splits the `maxsize` of `config` between them.
+
+    `health` is the `HealthPolicy` `PgPool` applies to the connections of its
+    pools, to validate, recycle and reap them.
+
+    The DSN is built, quoted and escaped once and then cached.
+    """
+
     def __init__(
         self,
         *,
         name: str | None = None,
         user: str,
-        host: str,
+        host: str | None = None,
         dbname: str,
-        password: str | None,
-        port: str | int | None,
+        password: str | None = None,
+        port: str | int | None = None,
         aliases: list[str] = [],
         config: dict[str, Any] | None = None,
+        connect_timeout: int | None = None,
+        keepalives: bool | None = None,
+        keepalives_idle: int | None = None,
+        keepalives_interval: int | None = None,
+        keepalives_count: int | None = None,
+        tcp_user_timeout: int | None = None,
+        sslmode: str | None = None,
+        pooler: str | None = None,
+        session: dict[str, Any] | None = None,
+        types: list[str] | None = None,
+        event_loops: int | None = None,
+        health: HealthPolicy | None = None,
     ) -> None:
+        _validate_non_negative_int("connect_timeout", connect_timeout)
+        _validate_non_negative_int("keepalives_idle", keepalives_idle)
+        _validate_non_negative_int("keepalives_interval", keepalives_interval)
+        _validate_non_negative_int("keepalives_count", keepalives_count)
+        _validate_non_negative_int("tcp_user_timeout", tcp_user_timeout)
+        _validate_non_negative_int("event_loops", event_loops)
+        if event_loops == 0:
+            raise ValueError("Connection parameter `event_loops` must be positive")
+        if keepalives is not None and type(keepalives) is not bool:
+            raise TypeError("Connection parameter `keepalives` must be a boolean or None")
+        if sslmode is not None and sslmode not in _SSL_MODES:
+            raise ValueError(
+                f"Connection parameter `sslmode` must be one of {', '.join(_SSL_MODES)}"
+            )
+        if pooler is not None and pooler not in _POOLERS:
+            raise ValueError(
+                f"Connection parameter `pooler` must be one of {', '.join(_POOLERS)}"
+            )
+        for setting in session or {}:
+            validate_setting_name(setting)
+        if types is not None and not (
+            isinstance(types, list) and all(type(type_name) is str for type_name in types)
+        ):
+            raise TypeError("Connection parameter `types` must be a list of strings or None")
+        if health is not None and not isinstance(health, HealthPolicy):
+            raise TypeError("Connection parameter `health` must be a HealthPolicy or None")
+
         self.name = name
         self.user = user
         self.host = host
@@ -22,11 +131,51 @@ class PgConnection:
         self.port = port
         self.aliases = aliases
         self.config = config or {}
+        self.connect_timeout = connect_timeout
+        self.keepalives = keepalives
+        self.keepalives_idle = keepalives_idle
+        self.keepalives_interval = keepalives_interval
+        self.keepalives_count = keepalives_count
+        self.tcp_user_timeout = tcp_user_timeout
+        self.sslmode = sslmode
+        self.pooler = pooler
+        self.session = session or {}
+        self.types = types or []
+        self.event_loops = event_loops
+        self.health = health
+        self._dsn: str | None = None
+
+    def get_dsn_params(self) -> dict[str, str | int]:
+        params: dict[str, str | int | bool | None] = {
+            "dbname": self.dbname,
+            "user": self.user,
+            "host": self.host,
+            "password": self.password or None,
+            "port": self.port or None,
+            "connect_timeout": self.connect_timeout,
+            "keepalives": self.keepalives,
+            "keepalives_idle": self.keepalives_idle,
+            "keepalives_interval": self.keepalives_interval,
+            "keepalives_count": self.keepalives_count,
+            "tcp_user_timeout": self.tcp_user_timeout,
+            "sslmode": self.sslmode,
+            "options": self._get_session_options(),
+        }
+        return {
+            key: int(value) if type(value) is bool else value
+            for key, value in params.items()
+            if value is not None
+        }
+
+    def _get_session_options(self) -> str | None:
+        if not self.session or self.pooler == PGBOUNCER_TRANSACTION_POOLER:
+            return None
+        return " ".join(
+            f"-c {setting}={_escape_option_value(format_setting_value(value))}"
+            for setting, value in self.session.items()
+        )
 
     def get_dsn(self) -> str:
-        dsn = f"dbname={self.dbname} user={self.user} host={self.host}"
-        if self.password:
-            dsn += f" password={self.password}"
-        if self.port:
-            dsn += f" port={self.port}"
-        return dsn
+        if self._dsn is None:
+            self._dsn = make_dsn(**self.get_dsn_params())
+        return self._dsn
@@ -0,0 +1,46 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+
+_deadline: ContextVar[float | None] = ContextVar("applipy_pg_deadline", default=None)
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+@contextmanager
+def deadline(timeout: float) -> Iterator[None]:
+    """
+    Sets a deadline `timeout` seconds from now for the database work done
+    within the context, including from tasks created inside it:
+
+        with deadline(0.5):
+            async with pool.cursor() as cur:
+                ...
+
+    `PgPool` fails fast with `DeadlineExceededError` once the deadline has
+    passed, bounds the time waiting for a connection by the remaining time
+    and sets it as the `statement_timeout` of the cursor's connection. A
+    nested deadline can only shorten the outer one.
+    """
+    at = time.monotonic() + timeout
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_remaining_time() -> float | None:
+    """
+    Returns the seconds left until the current deadline, or `None` if no
+    deadline is set.
+    """
+    at = _deadline.get()
+    if at is None:
+        return None
+    return at - time.monotonic()
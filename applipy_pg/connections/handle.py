@@ -3,17 +3,29 @@ import asyncio
 from applipy import AppHandle
 
 from .pool_handle import ApplipyPgPoolHandle
+from .statements import ApplipyPgCollectorHandle
+from .writer import ApplipyPgWriterHandle
 
 
 class PgAppHandle(AppHandle):
-    def __init__(self, pool_handles: list[ApplipyPgPoolHandle]) -> None:
+    def __init__(
+        self,
+        pool_handles: list[ApplipyPgPoolHandle],
+        writer_handles: list[ApplipyPgWriterHandle],
+        collector_handles: list[ApplipyPgCollectorHandle],
+    ) -> None:
         self.pool_handles = pool_handles
+        self.writer_handles = writer_handles
+        self.collector_handles = collector_handles
+
+    async def on_start(self) -> None:
+        await asyncio.gather(*(collector_handle.start() for collector_handle in self.collector_handles))
 
     async def on_shutdown(self) -> None:
-        coros = []
-        for pool_handle in self.pool_handles:
-            pool = await pool_handle.pool()
-            pool.close()
-            coros.append(pool.wait_closed())
+        try:
+            await asyncio.gather(*(collector_handle.close() for collector_handle in self.collector_handles))
 
-        await asyncio.gather(*coros)
+            # Buffered rows are flushed before the pools are closed
+            await asyncio.gather(*(writer_handle.close() for writer_handle in self.writer_handles))
+        finally:
+            await asyncio.gather(*(pool_handle.close() for pool_handle in self.pool_handles))
@@ -0,0 +1,167 @@
+import asyncio
+import random
+import weakref
+from dataclasses import dataclass
+
+import psycopg2
+from aiopg import (
+    Connection,
+    Pool,
+)
+
+
+def _validate_seconds(name: str, value: float | None) -> None:
+    if value is not None and (type(value) not in (int, float) or value <= 0):
+        raise ValueError(f"Invalid {name}, must be a positive number or None: {value!r}")
+
+
+class HealthPolicy:
+    """
+    How `PgPool` keeps its connections healthy, read from a connection's
+    `health`:
+
+    - `validate_idle_after`: connections idle for longer than this number of
+      seconds are validated with a `SELECT 1`, taking up to
+      `validation_timeout` seconds, before being handed out. Connections
+      that fail the validation are closed and another one is acquired.
+    - `max_lifetime`: seconds after which a connection is closed, instead of
+      being handed out. Each connection's lifetime is shortened by a random
+      fraction of up to `max_lifetime_jitter`, so that connections opened
+      together are not all recycled at once.
+    - `reap_idle_after`: connections idle for longer than this number of
+      seconds are closed, as long as the pool keeps `minsize` connections.
+
+    Everything is disabled by default.
+    """
+
+    def __init__(
+        self,
+        *,
+        validate_idle_after: float | None = None,
+        validation_timeout: float = 5.0,
+        max_lifetime: float | None = None,
+        max_lifetime_jitter: float = 0.1,
+        reap_idle_after: float | None = None,
+    ) -> None:
+        _validate_seconds("validate_idle_after", validate_idle_after)
+        if type(validation_timeout) not in (int, float) or validation_timeout <= 0:
+            raise ValueError(f"Invalid validation_timeout, must be a positive number: {validation_timeout!r}")
+        _validate_seconds("max_lifetime", max_lifetime)
+        if type(max_lifetime_jitter) not in (int, float) or not 0 <= max_lifetime_jitter < 1:
+            raise ValueError(
+                f"Invalid max_lifetime_jitter, must be a number from 0 up to 1: {max_lifetime_jitter!r}"
+            )
+        _validate_seconds("reap_idle_after", reap_idle_after)
+        self.validate_idle_after = validate_idle_after
+        self.validation_timeout = validation_timeout
+        self.max_lifetime = max_lifetime
+        self.max_lifetime_jitter = max_lifetime_jitter
+        self.reap_idle_after = reap_idle_after
+
+
+@dataclass(kw_only=True)
+class HealthStats:
+    """Counters of the connections validated, recycled and reaped by a `PgPool`."""
+
+    validations: int = 0
+    validation_failures: int = 0
+    recycles: int = 0
+    reaped: int = 0
+
+
+class _ConnectionState:
+    __slots__ = ("expires_at", "released_at")
+
+    def __init__(self, expires_at: float | None, released_at: float) -> None:
+        self.expires_at = expires_at
+        self.released_at = released_at
+
+
+class ConnectionHealth:
+    """
+    Applies a `HealthPolicy` to the connections of the pools of a `PgPool`,
+    tracking when each connection expires and was last released.
+    """
+
+    def __init__(self, policy: HealthPolicy | None, stats: HealthStats) -> None:
+        self._policy = policy or HealthPolicy()
+        self._stats = stats
+        self._states: weakref.WeakKeyDictionary[Connection, _ConnectionState] = weakref.WeakKeyDictionary()
+
+    @property
+    def is_needed(self) -> bool:
+        return (
+            self._policy.validate_idle_after is not None
+            or self._policy.max_lifetime is not None
+            or self._policy.reap_idle_after is not None
+        )
+
+    @property
+    def reap_interval(self) -> float | None:
+        if self._policy.reap_idle_after is None:
+            return None
+        return self._policy.reap_idle_after / 2
+
+    def on_connect(self, conn: Connection) -> None:
+        self._get_state(conn)
+
+    def on_release(self, conn: Connection) -> None:
+        if not conn.closed:
+            self._get_state(conn).released_at = asyncio.get_running_loop().time()
+
+    async def check(self, conn: Connection) -> bool:
+        """
+        Returns whether the connection can be handed out. Otherwise, it is
+        closed, so that the pool discards it when released.
+        """
+        if self._policy.validate_idle_after is None and self._policy.max_lifetime is None:
+            return True
+        now = asyncio.get_running_loop().time()
+        state = self._get_state(conn)
+        if state.expires_at is not None and now >= state.expires_at:
+            conn.close()
+            self._stats.recycles += 1
+            return False
+        validate_idle_after = self._policy.validate_idle_after
+        if validate_idle_after is not None and now - self._idle_since(conn, state) >= validate_idle_after:
+            self._stats.validations += 1
+            try:
+                async with asyncio.timeout(self._policy.validation_timeout):
+                    async with conn.cursor() as cur:
+                        await cur.execute("SELECT 1")
+            except (psycopg2.Error, OSError, TimeoutError):
+                self._stats.validation_failures += 1
+                conn.close()
+                return False
+        return True
+
+    def reap(self, pool: Pool) -> None:
+        """Closes the free connections of the pool idle for too long, down to `minsize`."""
+        reap_idle_after = self._policy.reap_idle_after
+        if reap_idle_after is None or pool.closed:
+            return
+        now = asyncio.get_running_loop().time()
+        # There is no public API to close specific free connections
+        for conn in list(pool._free):
+            if pool.size <= pool.minsize:
+                break
+            if now - self._idle_since(conn, self._get_state(conn)) >= reap_idle_after:
+                pool._free.remove(conn)
+                conn.close()
+                self._stats.reaped += 1
+
+    def _get_state(self, conn: Connection) -> _ConnectionState:
+        state = self._states.get(conn)
+        if state is None:
+            now = asyncio.get_running_loop().time()
+            expires_at = None
+            if self._policy.max_lifetime is not None:
+                expires_at = now + self._policy.max_lifetime * (
+                    1 - random.uniform(0, self._policy.max_lifetime_jitter)
+                )
+            state = self._states[conn] = _ConnectionState(expires_at, now)
+        return state
+
+    def _idle_since(self, conn: Connection, state: _ConnectionState) -> float:
+        # aiopg only tracks when the last cursor was opened
+        return max(conn.last_usage, state.released_at)
@@ -1,3 +1,8 @@
+from typing import (
+    Any,
+    Mapping,
+)
+
 from applipy import (
     BindFunction,
     Config,
@@ -11,6 +16,32 @@ from .pool_handle import (
     ApplipyPgPoolHandle,
     PgPool,
 )
+from .registry import (
+    PgPoolRegistry,
+    read_connections,
+)
+from .replay import (
+    PgRecordingPool,
+    PgReplayPool,
+)
+from .statements import (
+    ApplipyPgCollectorHandle,
+    PgStatementsCollector,
+)
+from .writer import (
+    ApplipyPgWriterHandle,
+    PgBufferedWriter,
+)
+
+
+def _create_pool(connection: PgConnection, conn: Mapping[str, Any]) -> PgPool:
+    if "record" in conn and "replay" in conn:
+        raise ValueError(f"Connection `{connection.name}` cannot both record and replay")
+    if "record" in conn:
+        return PgRecordingPool(connection, **dict(conn["record"]))
+    if "replay" in conn:
+        return PgReplayPool(connection, **dict(conn["replay"]))
+    return PgPool(connection)
 
 
 class PgModule(Module):
@@ -18,25 +49,25 @@ class PgModule(Module):
         self.config = config
 
     def configure(self, bind: BindFunction, register: RegisterFunction) -> None:
-        global_config = self.config.get("pg.global_config", {})
-        for conn in self.config.get("pg.connections", []):
-            db_config = {}
-            db_config.update(dict(global_config))
-            db_config.update(dict(conn.get("config", {})))
-            connection = PgConnection(
-                name=conn.get('name'),
-                user=conn['user'],
-                host=conn['host'],
-                dbname=conn['dbname'],
-                password=conn.get('password'),
-                port=conn.get('port'),
-                aliases=conn.get('aliases', []),
-                config=db_config,
-            )
-            pool = PgPool(connection)
+        registry = PgPoolRegistry()
+        bind(PgPoolRegistry, registry)
+        for connection, conn in read_connections(self.config):
+            pool = _create_pool(connection, conn)
+            registry.add(connection.name, pool)
             bind(ApplipyPgPoolHandle, pool)
             bind(PgPool, pool, name=connection.name)
+            writer = PgBufferedWriter(pool, **dict(conn.get("writer", {})))
+            bind(ApplipyPgWriterHandle, writer)
+            bind(PgBufferedWriter, writer, name=connection.name)
+            collector = None
+            if "statements" in conn:
+                collector = PgStatementsCollector(pool, **dict(conn["statements"]))
+                bind(ApplipyPgCollectorHandle, collector)
+                bind(PgStatementsCollector, collector, name=connection.name)
             for alias in connection.aliases:
                 bind(PgPool, pool, name=alias)
+                bind(PgBufferedWriter, writer, name=alias)
+                if collector is not None:
+                    bind(PgStatementsCollector, collector, name=alias)
 
         register(PgAppHandle)
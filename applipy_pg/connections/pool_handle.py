@@ -1,25 +1,77 @@
+import asyncio
+import functools
+import logging
+import threading
+import weakref
 from types import TracebackType
 from typing import (
+    TYPE_CHECKING,
     Any,
+    AsyncContextManager,
+    Awaitable,
+    Callable,
+    Mapping,
     Optional,
     Protocol,
     Type,
+    TypeVar,
 )
 
 import aiopg
 from aiopg import (
+    Connection,
     Cursor,
     Pool,
 )
 from aiopg.pool import _PoolCursorContextManager
+from aiopg.utils import _ContextManager
+from psycopg2.extensions import QueryCanceledError
 
-from .connection import PgConnection
+from .connection import (
+    PGBOUNCER_TRANSACTION_POOLER,
+    PgConnection,
+)
+from .columns import ColumnsBuilder
+from .deadline import (
+    DeadlineExceededError,
+    get_remaining_time,
+)
+from .health import (
+    ConnectionHealth,
+    HealthStats,
+)
+from .row_decoder import get_row_decoder
+from .settings import (
+    format_setting_value,
+    get_scoped_settings,
+)
+from .types import TypeCache
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+_T = TypeVar("_T")
+_logger = logging.getLogger(__name__)
+_FETCH_BATCH_SIZE = 1000
+# Seconds to wait for the backend of a connection closed while running a
+# statement to be terminated
+_TERMINATE_TIMEOUT = 5.0
+# The client-side timeout of statements run within a deadline is a bit longer
+# than their statement_timeout, so that the server cancels them first and the
+# connection does not have to be closed.
+_DEADLINE_CLIENT_TIMEOUT_GRACE = 0.1
+# aiopg.create_pool() parameters that also apply to aiopg.connect()
+_CONNECT_CONFIG_KEYS = ("timeout", "enable_json", "enable_hstore", "enable_uuid", "echo")
 
 
 class ApplipyPgPoolHandle(Protocol):
     async def pool(self) -> Pool:
         ...
 
+    async def close(self) -> None:
+        ...
+
 
 class _ApplipyPgPoolContextManager:
     def __init__(
@@ -31,6 +83,11 @@ class _ApplipyPgPoolContextManager:
         withhold: bool = False,
         *,
         timeout: Optional[float] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+        session_settings: Optional[Mapping[str, Any]] = None,
+        acquire_timeout: Optional[float] = None,
+        on_abandoned: Optional[Callable[[int], Awaitable[None]]] = None,
+        health: Optional[ConnectionHealth] = None,
     ) -> None:
         self._pool_handle = pool_handle
         self._name = name
@@ -38,18 +95,54 @@ class _ApplipyPgPoolContextManager:
         self._scrollable = scrollable
         self._withhold = withhold
         self._timeout = timeout
+        self._settings = settings
+        self._session_settings = session_settings
+        self._acquire_timeout = acquire_timeout
+        self._on_abandoned = on_abandoned
+        self._health = health
+        self._backend_pid: int | None = None
         self._cursor_ctx_manager: _PoolCursorContextManager | None = None
+        self._cursor: Cursor | None = None
+        self._settings_to_reset: list[str] = []
 
     async def __aenter__(self) -> Cursor:
-        pool = await self._pool_handle.pool()
-        self._cursor_ctx_manager = await pool.cursor(
-            self._name,
-            self._cursor_factory,
-            self._scrollable,
-            self._withhold,
-            timeout=self._timeout,
-        )
-        return self._cursor_ctx_manager.__enter__()
+        acquire_timeout = asyncio.timeout(self._acquire_timeout)
+        try:
+            async with acquire_timeout:
+                pool = await self._pool_handle.pool()
+                conn = await self._acquire(pool)
+                try:
+                    cursor = await conn.cursor(
+                        self._name,
+                        self._cursor_factory,
+                        self._scrollable,
+                        self._withhold,
+                        timeout=self._timeout,
+                    )
+                except BaseException:
+                    pool.release(conn)
+                    raise
+                self._cursor_ctx_manager = _PoolCursorContextManager(pool, conn, cursor)
+        except TimeoutError as e:
+            # Other timeouts, i.e. aiopg's own, are not caused by the deadline
+            if acquire_timeout.expired():
+                raise DeadlineExceededError("Deadline exceeded while acquiring a connection") from e
+            raise
+        cur = self._cursor_ctx_manager.__enter__()
+        # Read locally from libpq, it is needed if the connection is lost
+        self._backend_pid = cur.connection.raw.get_backend_pid()
+        try:
+            if self._session_settings:
+                self._settings_to_reset = list(self._session_settings)
+                await cur.execute(*_set_config_query(self._session_settings, is_local=False))
+            if self._settings:
+                self._cursor = cur
+                query, params = _set_config_query(self._settings, is_local=True)
+                await cur.execute(f"BEGIN; {query}", params)
+        except BaseException as e:
+            await self.__aexit__(type(e), e, e.__traceback__)
+            raise
+        return cur
 
     async def __aexit__(
         self,
@@ -59,7 +152,100 @@ class _ApplipyPgPoolContextManager:
     ) -> None:
         if self._cursor_ctx_manager is None:
             return
-        self._cursor_ctx_manager.__exit__(exc_type, exc, tb)
+        # aiopg raises CancelledError when a statement is canceled by the
+        # server, i.e. by statement_timeout, which would be mistaken for the
+        # cancellation of the task. The original error is raised instead.
+        query_canceled_error: QueryCanceledError | None = None
+        if isinstance(exc, asyncio.CancelledError) and isinstance(exc.__context__, QueryCanceledError):
+            query_canceled_error = exc.__context__
+        try:
+            if self._cursor is not None and not self._cursor.closed:
+                await self._cursor.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self._cursor = None
+            await self._reset_session_settings()
+            conn = self._cursor_ctx_manager._conn
+            self._cursor_ctx_manager.__exit__(exc_type, exc, tb)
+            if self._health is not None and conn is not None:
+                self._health.on_release(conn)
+            # aiopg closes the connection when an operation is cancelled or
+            # times out, but the server keeps running the statement.
+            if (
+                isinstance(exc, (asyncio.CancelledError, TimeoutError))
+                and query_canceled_error is None
+                and conn is not None
+                and conn.closed
+                and self._on_abandoned is not None
+                and self._backend_pid is not None
+            ):
+                await asyncio.shield(asyncio.ensure_future(self._on_abandoned(self._backend_pid)))
+        deadline_exceeded = self._acquire_timeout is not None and (get_remaining_time() or 0) <= 0
+        if query_canceled_error is not None:
+            if deadline_exceeded:
+                raise DeadlineExceededError("Deadline exceeded while executing a statement") from query_canceled_error
+            raise query_canceled_error
+        if deadline_exceeded and isinstance(exc, TimeoutError) and not isinstance(exc, DeadlineExceededError):
+            raise DeadlineExceededError("Deadline exceeded while executing a statement") from exc
+
+    async def _acquire(self, pool: Pool) -> Connection:
+        """
+        Acquires a connection from the pool, discarding the ones that fail
+        the health checks.
+        """
+        while True:
+            conn = await pool.acquire()
+            try:
+                if self._health is None or await self._health.check(conn):
+                    return conn
+            except BaseException:
+                conn.close()
+                raise
+            finally:
+                if conn.closed:
+                    pool.release(conn)
+
+    async def _reset_session_settings(self) -> None:
+        if not self._settings_to_reset or self._cursor_ctx_manager is None:
+            return
+        conn = self._cursor_ctx_manager._conn
+        settings_to_reset, self._settings_to_reset = self._settings_to_reset, []
+        if conn is None or conn.closed:
+            return
+        try:
+            async with conn.cursor() as cur:
+                # Setting names are validated when the settings are scoped
+                await cur.execute("".join(f"RESET {setting};" for setting in settings_to_reset))
+        except Exception:
+            # The connection must not go back to the pool with the settings
+            conn.close()
+
+
+def _set_config_query(settings: Mapping[str, Any], *, is_local: bool) -> tuple[str, list[Any]]:
+    query = "SELECT " + ", ".join(
+        f"set_config(%s, %s, {'true' if is_local else 'false'})" for _ in settings
+    )
+    params: list[Any] = []
+    for setting, value in settings.items():
+        params.extend((setting, format_setting_value(value)))
+    return query, params
+
+
+async def _run_on_pool(pool_task: "asyncio.Task[Pool]", func: Callable[[Pool], Awaitable[None]]) -> None:
+    try:
+        pool = await pool_task
+    except Exception:
+        return
+    await func(pool)
+
+
+def _create_type_cache(connection: PgConnection) -> TypeCache:
+    return TypeCache(
+        hstore=connection.config.get("enable_hstore", True),
+        type_names=connection.types,
+        # hstore is enabled by default, so it is only looked up again when
+        # missing if it was explicitly enabled
+        hstore_required=connection.config.get("enable_hstore") is True,
+    )
 
 
 class PgPool:
@@ -73,22 +259,260 @@ class PgPool:
             # here cur is a aiopg.Cursor
             ...
 
+    Server settings can be applied for the duration of a cursor block. They
+    are set with `SET LOCAL` semantics inside a transaction that is committed
+    when the block exits (or rolled back if it raises):
+
+        async with pool.cursor(settings={"statement_timeout": "5s"}) as cur:
+            ...
+
+    Settings scoped with `scoped_settings()` are set on the connection when
+    the cursor is acquired and reset when it is released.
+
+    Within a `deadline()`, the remaining time bounds the wait for a
+    connection, the client-side timeout of the cursor's operations and the
+    `statement_timeout` of the connection. Once the deadline has passed,
+    `DeadlineExceededError` is raised without acquiring a connection.
+
+    If the task is cancelled, or an operation times out, while a statement
+    runs, aiopg closes the connection, so it is not returned to the pool.
+    The server would still run the statement, so its backend is terminated,
+    unless connecting through a transaction pooler.
+
+    Rows can be mapped to dataclasses, NamedTuples or classes with __slots__,
+    matching columns to fields by name:
+
+        users = await pool.fetch_as(User, "SELECT id, name FROM users")
+
+    Numeric results can be fetched as one NumPy masked array per column, with
+    NULL values masked (requires NumPy, available as the `numpy` extra):
+
+        columns = await pool.fetch_columns("SELECT ts, value FROM metrics")
+
+    The OIDs of hstore and of the connection's custom `types` are resolved
+    once per pool and their typecasters registered on every new connection
+    without further catalog queries. After the types change, call:
+
+        await pool.refresh_types()
+
     For more advanced usage, the underlying aiopg.Pool can be retrieved doing:
 
         aiopg_pool = await pool.pool()
+
+    The connection's `health` policy can validate connections that have
+    been idle for a while before handing them out, recycle connections
+    after a jittered maximum lifetime and close idle connections above
+    `minsize`. Their counters are kept in `health_stats`.
+
+    aiopg pools are bound to the event loop that created them, so a
+    separate pool is created for every event loop the PgPool is used from.
+    With the connection's `event_loops` set, `maxsize` is split between them.
+
+    When the connection's `pooler` is `pgbouncer-transaction`, features bound
+    to a server session, like named cursors, are refused and the connection's
+    session settings are applied to every cursor block as `settings`.
     """
 
     def __init__(self, connection: PgConnection) -> None:
         self._connection = connection
-        self._pool: Pool | None = None
+        self._pools: dict[asyncio.AbstractEventLoop, asyncio.Task[Pool]] = {}
+        self._draining_pools: list[tuple[asyncio.AbstractEventLoop, asyncio.Task[Pool]]] = []
+        self._drain_futures: set[asyncio.Future[list[None]]] = set()
+        self._pools_lock = threading.Lock()
+        self._type_cache = _create_type_cache(connection)
+        self.health_stats = HealthStats()
+        self._health = ConnectionHealth(connection.health, self.health_stats)
+        self._reapers: dict[Pool, asyncio.Task[None]] = {}
+        # asyncio locks are bound to an event loop, so there is one per loop
+        self._terminate_locks: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._backends_to_terminate: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, set[int]] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @property
+    def connection(self) -> PgConnection:
+        return self._connection
 
     async def pool(self) -> Pool:
-        if self._pool is None:
-            self._pool = await aiopg.create_pool(
-                self._connection.get_dsn(), **self._connection.config
-            )
+        """
+        Returns the pool of the running event loop, creating it the first
+        time it is requested from that loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._pools_lock:
+            pool_task = self._pools.get(loop)
+            if pool_task is None or (
+                pool_task.done() and (pool_task.cancelled() or pool_task.exception() is not None)
+            ):
+                pool_task = loop.create_task(self._create_pool())
+                self._pools[loop] = pool_task
+        return await asyncio.shield(pool_task)
+
+    async def close(self) -> None:
+        """Closes the pools of every event loop, including the draining ones."""
+        with self._pools_lock:
+            pool_tasks = [*self._pools.items(), *self._draining_pools]
+        await asyncio.gather(*self._run_on_pool_tasks(pool_tasks, self._close_pool))
+
+    async def reconfigure(self, connection: PgConnection) -> None:
+        """
+        Applies new connection parameters, i.e. a new pool size, password or
+        host. New pools are created with them for the following
+        acquisitions, while the current pools are closed in the background
+        once their connections are released. Name and aliases cannot change.
+        """
+        if connection.name != self._connection.name or connection.aliases != self._connection.aliases:
+            raise ValueError("The name and aliases of a connection cannot be changed")
+        with self._pools_lock:
+            self._connection = connection
+            self._type_cache = _create_type_cache(connection)
+            self._health = ConnectionHealth(connection.health, self.health_stats)
+            old_pool_tasks = list(self._pools.items())
+            self._pools = {}
+            self._draining_pools.extend(old_pool_tasks)
+        drain_future = asyncio.gather(*self._run_on_pool_tasks(old_pool_tasks, self._close_pool))
+        self._drain_futures.add(drain_future)
+        drain_future.add_done_callback(functools.partial(self._on_drained, old_pool_tasks))
+
+    async def refresh_types(self) -> None:
+        """
+        Resolves the registered types again, i.e. after a migration changed
+        them. The idle connections of the pools are closed, so that they are
+        reopened with the refreshed types.
+        """
+        if not self._type_cache.is_needed:
+            return
+        self._type_cache.invalidate()
+        await asyncio.gather(*self._run_on_pools(Pool.clear))
+
+    async def _create_pool(self) -> Pool:
+        config = dict(self._connection.config)
+        if self._connection.event_loops is not None:
+            # The connections budget is split between the event loops
+            config["maxsize"] = max(1, config.get("maxsize", 10) // self._connection.event_loops)
+            config["minsize"] = min(config.get("minsize", 1), config["maxsize"])
+        if self._type_cache.is_needed:
+            config["enable_hstore"] = False
+        if self._type_cache.is_needed or self._health.is_needed:
+            config["on_connect"] = self._get_on_connect(config.get("on_connect"))
+        pool = await aiopg.create_pool(self._connection.get_dsn(), **config)
+        reap_interval = self._health.reap_interval
+        if reap_interval is not None:
+            with self._pools_lock:
+                self._reapers[pool] = asyncio.create_task(self._reap_idle_connections(pool, reap_interval))
+        return pool
+
+    async def _reap_idle_connections(self, pool: Pool, interval: float) -> None:
+        while not pool.closed:
+            await asyncio.sleep(interval)
+            self._health.reap(pool)
+
+    async def _close_pool(self, pool: Pool) -> None:
+        with self._pools_lock:
+            reaper = self._reapers.pop(pool, None)
+        if reaper is not None:
+            reaper.cancel()
+        pool.close()
+        await pool.wait_closed()
+
+    async def _terminate_backend(self, backend_pid: int) -> None:
+        """
+        Terminates the backend of a connection that was closed while running
+        a statement, waiting up to `_TERMINATE_TIMEOUT` seconds for it to exit.
+
+        Terminations are serialized, so that at most one side connection per
+        event loop is opened for them, and the backends abandoned meanwhile
+        are terminated together.
+        """
+        loop = asyncio.get_running_loop()
+        backend_pids = self._backends_to_terminate.setdefault(loop, set())
+        backend_pids.add(backend_pid)
+        async with self._terminate_locks.setdefault(loop, asyncio.Lock()):
+            if backend_pid not in backend_pids:
+                # Terminated along with the previous ones
+                return
+            pids = sorted(backend_pids)
+            backend_pids.clear()
+            try:
+                # Also bounds the time to open the connection
+                async with asyncio.timeout(2 * _TERMINATE_TIMEOUT):
+                    async with self.connect() as conn:
+                        async with conn.cursor() as cur:
+                            await cur.execute(
+                                "SELECT pg_terminate_backend(pid, %s) FROM unnest(%s::int[]) AS pid;",
+                                (int(_TERMINATE_TIMEOUT * 1000), pids),
+                            )
+            except Exception:
+                _logger.warning("Failed to terminate abandoned backends %s", pids, exc_info=True)
+
+    def _on_drained(
+        self,
+        pool_tasks: list[tuple[asyncio.AbstractEventLoop, "asyncio.Task[Pool]"]],
+        drain_future: "asyncio.Future[list[None]]",
+    ) -> None:
+        self._drain_futures.discard(drain_future)
+        with self._pools_lock:
+            self._draining_pools = [
+                pool_task for pool_task in self._draining_pools if pool_task not in pool_tasks
+            ]
+        if not drain_future.cancelled() and drain_future.exception() is not None:
+            _logger.warning("Failed to close pools after reconfiguring", exc_info=drain_future.exception())
+
+    def _run_on_pools(self, func: Callable[[Pool], Awaitable[None]]) -> list[Awaitable[None]]:
+        with self._pools_lock:
+            pool_tasks = list(self._pools.items())
+        return self._run_on_pool_tasks(pool_tasks, func)
+
+    def _run_on_pool_tasks(
+        self,
+        pool_tasks: list[tuple[asyncio.AbstractEventLoop, "asyncio.Task[Pool]"]],
+        func: Callable[[Pool], Awaitable[None]],
+    ) -> list[Awaitable[None]]:
+        """
+        Runs `func` on the given pools, in the event loop each pool belongs
+        to. Pools of loops that are no longer running are skipped.
+        """
+        current_loop = asyncio.get_running_loop()
+        awaitables: list[Awaitable[None]] = []
+        for loop, pool_task in pool_tasks:
+            if loop is current_loop:
+                awaitables.append(_run_on_pool(pool_task, func))
+            elif loop.is_running():
+                awaitables.append(
+                    asyncio.wrap_future(
+                        asyncio.run_coroutine_threadsafe(_run_on_pool(pool_task, func), loop)
+                    )
+                )
+        return awaitables
+
+    def _get_on_connect(
+        self, on_connect: Optional[Callable[[Connection], Awaitable[None]]]
+    ) -> Callable[[Connection], Awaitable[None]]:
+        async def init_connection(conn: Connection) -> None:
+            if self._type_cache.is_needed:
+                await self._type_cache.register(conn)
+            self._health.on_connect(conn)
+            if on_connect is not None:
+                await on_connect(conn)
 
-        return self._pool
+        return init_connection
+
+    def connect(self) -> _ContextManager[Connection]:
+        """
+        Opens a connection to the database outside of the pool, for work that
+        must not compete with the pool's connections. The caller is
+        responsible for closing it, i.e. using it as an async context manager.
+        """
+        return aiopg.connect(
+            self._connection.get_dsn(),
+            **{
+                key: value
+                for key, value in self._connection.config.items()
+                if key in _CONNECT_CONFIG_KEYS
+            },
+        )
 
     def cursor(
         self,
@@ -98,7 +522,76 @@ class PgPool:
         withhold: bool = False,
         *,
         timeout: Optional[float] = None,
-    ) -> _ApplipyPgPoolContextManager:
+        settings: Optional[Mapping[str, Any]] = None,
+    ) -> AsyncContextManager[Cursor]:
+        session_settings = get_scoped_settings()
+        remaining_time = get_remaining_time()
+        if remaining_time is not None:
+            if remaining_time <= 0:
+                raise DeadlineExceededError("Deadline exceeded before acquiring a connection")
+            client_timeout = remaining_time + _DEADLINE_CLIENT_TIMEOUT_GRACE
+            timeout = client_timeout if timeout is None else min(timeout, client_timeout)
+            session_settings = {
+                **session_settings,
+                "statement_timeout": f"{max(1, int(remaining_time * 1000))}ms",
+            }
+        if self._connection.pooler == PGBOUNCER_TRANSACTION_POOLER:
+            if name is not None or withhold:
+                raise ValueError(
+                    "Named cursors are not supported when using a transaction pooler"
+                )
+            if self._connection.session or session_settings:
+                settings = {**self._connection.session, **session_settings, **(settings or {})}
+            session_settings = {}
         return _ApplipyPgPoolContextManager(
-            self, name, cursor_factory, scrollable, withhold, timeout=timeout
+            self,
+            name,
+            cursor_factory,
+            scrollable,
+            withhold,
+            timeout=timeout,
+            settings=settings,
+            session_settings=session_settings,
+            acquire_timeout=remaining_time,
+            # Through a transaction pooler, the backend pid of the
+            # connection is not the one of the server backend
+            on_abandoned=None if self._connection.pooler == PGBOUNCER_TRANSACTION_POOLER else self._terminate_backend,
+            health=self._health,
         )
+
+    async def fetch_as(
+        self,
+        model: type[_T],
+        sql: str,
+        params: Any = None,
+        *,
+        timeout: Optional[float] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+    ) -> list[_T]:
+        async with self.cursor(timeout=timeout, settings=settings) as cur:
+            await cur.execute(sql, params)
+            if cur.description is None:
+                raise ValueError("Query did not return rows")
+            decode = get_row_decoder(model, tuple(column.name for column in cur.description))
+            result: list[_T] = []
+            while rows := await cur.fetchmany(_FETCH_BATCH_SIZE):
+                result.extend(map(decode, rows))
+            return result
+
+    async def fetch_columns(
+        self,
+        sql: str,
+        params: Any = None,
+        *,
+        dtypes: Optional[Mapping[str, Any]] = None,
+        timeout: Optional[float] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+    ) -> dict[str, "np.ma.MaskedArray[Any, Any]"]:
+        async with self.cursor(timeout=timeout, settings=settings) as cur:
+            await cur.execute(sql, params)
+            if cur.description is None:
+                raise ValueError("Query did not return rows")
+            builder = ColumnsBuilder.from_description(cur.description, dtypes)
+            while rows := await cur.fetchmany(_FETCH_BATCH_SIZE):
+                builder.append(rows)
+            return builder.build()
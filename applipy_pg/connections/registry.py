@@ -0,0 +1,94 @@
+from typing import (
+    Any,
+    Iterator,
+    Mapping,
+)
+
+from .connection import PgConnection
+from .health import HealthPolicy
+from .pool_handle import PgPool
+
+
+def read_connections(config: Any) -> Iterator[tuple[PgConnection, Mapping[str, Any]]]:
+    """
+    Builds the connections declared in `pg.connections`, merged with
+    `pg.global_config` and `pg.global_session`. Yields each connection with
+    its raw configuration.
+    """
+    global_config = config.get("pg.global_config", {})
+    global_session = config.get("pg.global_session", {})
+    for conn in config.get("pg.connections", []):
+        db_config = {}
+        db_config.update(dict(global_config))
+        db_config.update(dict(conn.get("config", {})))
+        db_session = {}
+        db_session.update(dict(global_session))
+        db_session.update(dict(conn.get("session", {})))
+        connection = PgConnection(
+            name=conn.get('name'),
+            user=conn['user'],
+            host=conn.get('host'),
+            dbname=conn['dbname'],
+            password=conn.get('password'),
+            port=conn.get('port'),
+            aliases=list(conn.get('aliases', [])),
+            config=db_config,
+            connect_timeout=conn.get('connect_timeout'),
+            keepalives=conn.get('keepalives'),
+            keepalives_idle=conn.get('keepalives_idle'),
+            keepalives_interval=conn.get('keepalives_interval'),
+            keepalives_count=conn.get('keepalives_count'),
+            tcp_user_timeout=conn.get('tcp_user_timeout'),
+            sslmode=conn.get('sslmode'),
+            pooler=conn.get('pooler'),
+            session=db_session,
+            types=list(conn.get('types', [])),
+            event_loops=conn.get('event_loops'),
+            health=HealthPolicy(**dict(conn['health'])) if 'health' in conn else None,
+        )
+        yield connection, conn
+
+
+class PgPoolRegistry:
+    """
+    Holds the pools declared in the configuration, by name, and applies
+    configuration changes to them without restarting the application:
+
+        registry: PgPoolRegistry
+        await registry.apply_config(new_config)
+
+    Every pool is reconfigured in place (see `PgPool.reconfigure()`), so the
+    `PgPool` objects already injected, under their names and aliases, keep
+    working with the new parameters.
+    """
+
+    def __init__(self) -> None:
+        self._pools: dict[str | None, PgPool] = {}
+
+    def add(self, name: str | None, pool: PgPool) -> None:
+        self._pools[name] = pool
+
+    def get(self, name: str | None = None) -> PgPool:
+        """Returns the pool with the given name or alias."""
+        if name in self._pools:
+            return self._pools[name]
+        for pool in self._pools.values():
+            if name in pool.connection.aliases:
+                return pool
+        raise KeyError(name)
+
+    async def apply_config(self, config: Any) -> None:
+        """
+        Reconfigures the pools with the connections declared in `config`.
+        Connections cannot be added or removed, and their names and aliases
+        cannot change.
+        """
+        connections = [connection for connection, _ in read_connections(config)]
+        names = {connection.name for connection in connections}
+        if len(names) != len(connections) or names != set(self._pools):
+            raise ValueError("Connections cannot be added, removed or renamed without restarting")
+        for connection in connections:
+            if connection.aliases != self._pools[connection.name].connection.aliases:
+                raise ValueError("The aliases of a connection cannot be changed")
+        for connection in connections:
+            await self._pools[connection.name].reconfigure(connection)
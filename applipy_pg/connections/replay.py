@@ -0,0 +1,392 @@
+import asyncio
+import os
+import pickle
+import random
+import threading
+from types import TracebackType
+from typing import (
+    Any,
+    AsyncContextManager,
+    Optional,
+    Sequence,
+    Type,
+    cast,
+)
+
+import psycopg2
+import psycopg2.errors
+from aiopg import (
+    Connection,
+    Cursor,
+    Pool,
+)
+from aiopg.utils import _ContextManager
+from psycopg2 import sql
+
+from .connection import PgConnection
+from .deadline import (
+    DeadlineExceededError,
+    get_remaining_time,
+)
+from .pool_handle import PgPool
+
+
+_RECORDING_VERSION = 1
+
+# An exchange is stored as a plain dict, so that recordings do not depend on
+# the classes of this module:
+#   {"description": ..., "rows": [...] | None, "rowcount": int, "error": (pgcode, class name, message) | None}
+_Exchange = dict[str, Any]
+_ExchangeKey = tuple[str, str]
+
+
+class UnrecordedQueryError(LookupError):
+    pass
+
+
+def _normalize_param(value: Any) -> Any:
+    """
+    Replaces psycopg2 adapters, i.e. `Json` or `Binary`, whose reprs include
+    their memory address, by their type name and adapted value.
+    """
+    if isinstance(value, dict):
+        return {key: _normalize_param(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_normalize_param(item) for item in value)
+    if hasattr(value, "adapted"):
+        return (type(value).__name__, _normalize_param(value.adapted))
+    return value
+
+
+def _render_query(query: Any) -> str:
+    """
+    Renders a query to a string without a connection, so that the same
+    query has the same key when recording and when replaying.
+    """
+    if isinstance(query, bytes):
+        return query.decode()
+    if isinstance(query, sql.Composed):
+        return "".join(_render_query(part) for part in query.seq)
+    if isinstance(query, sql.SQL):
+        return str(query.string)
+    if isinstance(query, sql.Identifier):
+        return ".".join('"' + string.replace('"', '""') + '"' for string in query.strings)
+    if isinstance(query, sql.Literal):
+        return repr(_normalize_param(query.wrapped))
+    if isinstance(query, sql.Placeholder):
+        return "%s" if query.name is None else f"%({query.name})s"
+    return str(query)
+
+
+def _exchange_key(query: Any, params: Any) -> _ExchangeKey:
+    return _render_query(query), repr(_normalize_param(params))
+
+
+def _raise_error(error: tuple[Optional[str], str, str]) -> None:
+    pgcode, class_name, message = error
+    error_class: type[psycopg2.Error] = psycopg2.Error
+    if pgcode is not None:
+        try:
+            error_class = psycopg2.errors.lookup(pgcode)
+        except KeyError:
+            pass
+    else:
+        error_class = getattr(psycopg2, class_name, psycopg2.Error)
+    raise error_class(message)
+
+
+class _BufferedCursor:
+    """
+    The subset of `aiopg.Cursor` used to read the results of a statement,
+    served from a recorded exchange.
+    """
+
+    def __init__(self) -> None:
+        self._description: Optional[Sequence[Any]] = None
+        self._rows: list[Any] = []
+        self._position = 0
+        self._rowcount = -1
+        self._closed = False
+        self.arraysize = 1
+
+    @property
+    def description(self) -> Optional[Sequence[Any]]:
+        return self._description
+
+    @property
+    def rowcount(self) -> int:
+        return self._rowcount
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        self._closed = True
+
+    async def fetchone(self) -> Any:
+        self._check_result()
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    async def fetchmany(self, size: Optional[int] = None) -> list[Any]:
+        self._check_result()
+        start = self._position
+        self._position = min(len(self._rows), start + (self.arraysize if size is None else size))
+        return self._rows[start:self._position]
+
+    async def fetchall(self) -> list[Any]:
+        self._check_result()
+        start, self._position = self._position, len(self._rows)
+        return self._rows[start:]
+
+    def __aiter__(self) -> "_BufferedCursor":
+        return self
+
+    async def __anext__(self) -> Any:
+        row = await self.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    def _set_exchange(self, exchange: _Exchange) -> None:
+        self._description = exchange["description"]
+        self._rows = exchange["rows"] or []
+        self._position = 0
+        self._rowcount = exchange["rowcount"]
+
+    def _check_result(self) -> None:
+        if self._closed:
+            raise psycopg2.InterfaceError("cursor already closed")
+        if self._description is None:
+            raise psycopg2.ProgrammingError("no results to fetch")
+
+
+class _Recording:
+    def __init__(self, exchanges: Optional[dict[_ExchangeKey, list[_Exchange]]] = None) -> None:
+        self.exchanges = exchanges or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "_Recording":
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != _RECORDING_VERSION:
+            raise ValueError(f"Unsupported recording version in {path}: {data.get('version')!r}")
+        return cls(data["exchanges"])
+
+    def add(self, key: _ExchangeKey, exchange: _Exchange) -> None:
+        with self._lock:
+            self.exchanges.setdefault(key, []).append(exchange)
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            data = {"version": _RECORDING_VERSION, "exchanges": dict(self.exchanges)}
+        # Written to a temporary file first, so that a failed save does not
+        # leave a truncated recording behind
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+class _RecordingCursor(_BufferedCursor):
+    def __init__(self, cursor: Cursor, recording: _Recording) -> None:
+        super().__init__()
+        self._cursor = cursor
+        self._recording = recording
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    async def execute(self, operation: Any, parameters: Any = None, *, timeout: Optional[float] = None) -> None:
+        key = _exchange_key(operation, parameters)
+        try:
+            await self._cursor.execute(operation, parameters, timeout=timeout)
+        except psycopg2.Error as e:
+            self._recording.add(
+                key,
+                {"description": None, "rows": None, "rowcount": -1, "error": (e.pgcode, type(e).__name__, str(e))},
+            )
+            raise
+        # The rows are read eagerly, so that they are recorded even if the
+        # caller does not fetch them all
+        rows = await self._cursor.fetchall() if self._cursor.description is not None else None
+        exchange: _Exchange = {
+            "description": self._cursor.description,
+            "rows": rows,
+            "rowcount": self._cursor.rowcount,
+            "error": None,
+        }
+        self._recording.add(key, exchange)
+        self._set_exchange(exchange)
+
+
+class _RecordingContextManager:
+    def __init__(self, cursor_ctx_manager: AsyncContextManager[Cursor], recording: _Recording) -> None:
+        self._cursor_ctx_manager = cursor_ctx_manager
+        self._recording = recording
+
+    async def __aenter__(self) -> Cursor:
+        cur = await self._cursor_ctx_manager.__aenter__()
+        # Only the statements of the caller are recorded, not the ones
+        # setting up the cursor
+        return cast(Cursor, _RecordingCursor(cur, self._recording))
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        await self._cursor_ctx_manager.__aexit__(exc_type, exc, tb)
+
+
+class PgRecordingPool(PgPool):
+    """
+    `PgPool` that records the statements executed through `cursor()`, with
+    their results or errors, to be replayed by `PgReplayPool`. The
+    recording is written to `path` when the pool is closed, on application
+    shutdown, or when calling `save()`.
+
+    Recordings are pickled, so only replay recordings from trusted sources.
+    """
+
+    def __init__(self, connection: PgConnection, *, path: str) -> None:
+        if type(path) is not str or not path:
+            raise ValueError(f"Invalid path, must be a non-empty string: {path!r}")
+        super().__init__(connection)
+        self._path = path
+        self._recording = _Recording()
+
+    def cursor(self, *args: Any, **kwargs: Any) -> AsyncContextManager[Cursor]:
+        return _RecordingContextManager(super().cursor(*args, **kwargs), self._recording)
+
+    def save(self) -> None:
+        self._recording.save(self._path)
+
+    async def close(self) -> None:
+        try:
+            await super().close()
+        finally:
+            self.save()
+
+
+class _ReplayCursor(_BufferedCursor):
+    def __init__(self, replay_pool: "PgReplayPool") -> None:
+        super().__init__()
+        self._replay_pool = replay_pool
+
+    async def execute(self, operation: Any, parameters: Any = None, *, timeout: Optional[float] = None) -> None:
+        if self._closed:
+            raise psycopg2.InterfaceError("cursor already closed")
+        exchange = self._replay_pool._next_exchange(_exchange_key(operation, parameters))
+        await self._replay_pool._wait_latency()
+        if exchange["error"] is not None:
+            self._description = None
+            _raise_error(exchange["error"])
+        self._set_exchange(exchange)
+
+
+class _ReplayContextManager:
+    def __init__(self, replay_pool: "PgReplayPool") -> None:
+        self._replay_pool = replay_pool
+        self._acquired = False
+
+    async def __aenter__(self) -> Cursor:
+        remaining_time = get_remaining_time()
+        if remaining_time is not None and remaining_time <= 0:
+            raise DeadlineExceededError("Deadline exceeded before acquiring a connection")
+        try:
+            async with asyncio.timeout(remaining_time):
+                await self._replay_pool._connections.acquire()
+        except TimeoutError as e:
+            raise DeadlineExceededError("Deadline exceeded while acquiring a connection") from e
+        self._acquired = True
+        return cast(Cursor, _ReplayCursor(self._replay_pool))
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        if self._acquired:
+            self._acquired = False
+            self._replay_pool._connections.release()
+
+
+class PgReplayPool(PgPool):
+    """
+    Stand-in for `PgPool` that replays a recording made by `PgRecordingPool`
+    without connecting to a database, i.e. to test data access code:
+
+        pool = PgReplayPool(connection, path="tests/recordings/orders.pickle", latency=0.005)
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT id, name FROM users WHERE id = %s", (1,))
+            await cur.fetchone()
+
+    Statements are matched by query and parameters. Each match returns the
+    next recorded result of that statement, in recording order, repeating
+    the last one once they are exhausted. Recorded errors are raised again
+    and unrecorded statements raise `UnrecordedQueryError`.
+
+    Every statement takes `latency` seconds plus a random delay of up to
+    `jitter` seconds, drawn from a generator seeded with `seed`. At most
+    `maxsize` (from the connection's `config`) cursors are open at the same
+    time, like connections of a real pool, and deadlines are honoured, so
+    contention and timeouts can be simulated. Server settings are not
+    applied and there is no underlying aiopg pool or connection.
+    """
+
+    def __init__(
+        self,
+        connection: PgConnection,
+        *,
+        path: str,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        if type(path) is not str or not path:
+            raise ValueError(f"Invalid path, must be a non-empty string: {path!r}")
+        if type(latency) not in (int, float) or latency < 0:
+            raise ValueError(f"Invalid latency, must be a non-negative number: {latency!r}")
+        if type(jitter) not in (int, float) or jitter < 0:
+            raise ValueError(f"Invalid jitter, must be a non-negative number: {jitter!r}")
+        if seed is not None and type(seed) is not int:
+            raise ValueError(f"Invalid seed, must be an integer or None: {seed!r}")
+        super().__init__(connection)
+        self._recording = _Recording.load(path)
+        self._positions: dict[_ExchangeKey, int] = {}
+        self._latency = latency
+        self._jitter = jitter
+        self._random = random.Random(seed)
+        self._connections = asyncio.Semaphore(connection.config.get("maxsize", 10))
+
+    async def pool(self) -> Pool:
+        raise RuntimeError("PgReplayPool has no underlying aiopg pool")
+
+    def connect(self) -> _ContextManager[Connection]:
+        raise RuntimeError("PgReplayPool cannot open connections")
+
+    def cursor(self, *args: Any, **kwargs: Any) -> AsyncContextManager[Cursor]:
+        return _ReplayContextManager(self)
+
+    def _next_exchange(self, key: _ExchangeKey) -> _Exchange:
+        exchanges = self._recording.exchanges.get(key)
+        if not exchanges:
+            raise UnrecordedQueryError(f"Statement not found in the recording: {key[0]!r} with parameters {key[1]}")
+        position = self._positions.get(key, 0)
+        self._positions[key] = position + 1
+        return exchanges[min(position, len(exchanges) - 1)]
+
+    async def _wait_latency(self) -> None:
+        delay = self._latency + (self._random.uniform(0, self._jitter) if self._jitter else 0)
+        remaining_time = get_remaining_time()
+        if remaining_time is not None and remaining_time < delay:
+            await asyncio.sleep(max(0.0, remaining_time))
+            raise DeadlineExceededError("Deadline exceeded while executing a statement")
+        await asyncio.sleep(delay)
@@ -0,0 +1,81 @@
+import dataclasses
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Sequence,
+    TypeVar,
+    cast,
+)
+
+
+_T = TypeVar("_T")
+RowDecoder = Callable[[Sequence[Any]], _T]
+
+
+def _is_namedtuple(model: type) -> bool:
+    return issubclass(model, tuple) and hasattr(model, "_fields")
+
+
+def _get_slots(model: type) -> list[str]:
+    slots: list[str] = []
+    for cls in model.__mro__:
+        cls_slots = cls.__dict__.get("__slots__", ())
+        if isinstance(cls_slots, str):
+            cls_slots = (cls_slots,)
+        slots.extend(slot for slot in cls_slots if slot not in ("__dict__", "__weakref__"))
+    return slots
+
+
+def _get_model_fields(model: type) -> tuple[list[str], bool]:
+    """
+    Returns the names of the fields of the model and whether they are set
+    through the constructor (`True`) or directly on a bare instance (`False`).
+    """
+    if dataclasses.is_dataclass(model):
+        return [field.name for field in dataclasses.fields(model) if field.init], True
+    if _is_namedtuple(model):
+        return list(model._fields), True  # type: ignore[attr-defined]
+    slots = _get_slots(model)
+    if slots:
+        return slots, False
+    raise TypeError(
+        f"Cannot map rows to {model.__qualname__}: it must be a dataclass, a NamedTuple or define __slots__"
+    )
+
+
+def get_row_decoder(model: type[_T], column_names: tuple[str, ...]) -> RowDecoder[_T]:
+    """
+    Returns a function that turns a row with the given columns into an
+    instance of `model`, matching columns to fields by name.
+
+    Decoders are compiled once and cached by model and columns, so the
+    compilation cost is only paid once per query shape.
+    """
+    return cast(RowDecoder[_T], _compile_row_decoder(cast(type, model), column_names))
+
+
+@lru_cache(maxsize=1024)
+def _compile_row_decoder(model: type, column_names: tuple[str, ...]) -> RowDecoder[Any]:
+    if len(set(column_names)) != len(column_names):
+        raise ValueError(f"Duplicate column names in result: {', '.join(column_names)}")
+    fields, use_constructor = _get_model_fields(model)
+    unknown_columns = [name for name in column_names if name not in fields]
+    if unknown_columns:
+        raise ValueError(
+            f"Columns {', '.join(unknown_columns)} do not match any field of {model.__qualname__}"
+        )
+
+    if use_constructor:
+        arguments = ", ".join(f"{name}=row[{i}]" for i, name in enumerate(column_names))
+        source = f"def decode(row):\n    return model({arguments})\n"
+    else:
+        assignments = "".join(
+            f"    obj.{name} = row[{i}]\n" for i, name in enumerate(column_names)
+        )
+        source = f"def decode(row):\n    obj = new(model)\n{assignments}    return obj\n"
+
+    namespace: dict[str, Any] = {"model": model, "new": object.__new__}
+    exec(compile(source, f"<row decoder for {model.__qualname__}>", "exec"), namespace)
+    decoder: RowDecoder[Any] = namespace["decode"]
+    return decoder
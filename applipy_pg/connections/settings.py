@@ -0,0 +1,52 @@
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Iterator,
+    Mapping,
+)
+
+
+_SETTING_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+
+_scoped_settings: ContextVar[Mapping[str, Any]] = ContextVar(
+    "applipy_pg_scoped_settings", default={}
+)
+
+
+def validate_setting_name(setting: Any) -> None:
+    if type(setting) is not str or not _SETTING_NAME_RE.match(setting):
+        raise ValueError(f"Invalid setting name: {setting!r}")
+
+
+def format_setting_value(value: Any) -> str:
+    if type(value) is bool:
+        return "on" if value else "off"
+    return str(value)
+
+
+@contextmanager
+def scoped_settings(settings: Mapping[str, Any]) -> Iterator[None]:
+    """
+    Applies server settings to every cursor opened through any `PgPool` within
+    the context, including from tasks created inside it:
+
+        with scoped_settings({"lock_timeout": "5s"}):
+            async with pool.cursor() as cur:
+                ...
+
+    The settings are set on the connection when the cursor is acquired and
+    reset when it is released. Nested scopes override the outer ones.
+    """
+    for setting in settings:
+        validate_setting_name(setting)
+    token = _scoped_settings.set({**_scoped_settings.get(), **settings})
+    try:
+        yield
+    finally:
+        _scoped_settings.reset(token)
+
+
+def get_scoped_settings() -> Mapping[str, Any]:
+    return _scoped_settings.get()
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Protocol,
+    Sequence,
+)
+
+from aiopg import Connection
+from psycopg2.errors import UndefinedTable
+
+from .pool_handle import PgPool
+
+
+_logger = logging.getLogger(__name__)
+
+_SORT_KEYS = ("total_time", "calls", "io_blocks")
+_LOGGED_QUERY_LENGTH = 200
+
+# Statements are summed by queryid, merging the top-level and nested entries
+# of the same statement, and only the most expensive ones are fetched, which
+# bounds the snapshot size.
+_SNAPSHOT_QUERY = """
+SELECT
+    s.queryid,
+    min(s.query),
+    sum(s.calls)::bigint,
+    sum(s.total_exec_time)::float8,
+    sum(s.rows)::bigint,
+    sum(
+        s.shared_blks_read + s.shared_blks_written
+        + s.local_blks_read + s.local_blks_written
+        + s.temp_blks_read + s.temp_blks_written
+    )::bigint
+FROM pg_stat_statements s
+WHERE s.userid = (SELECT oid FROM pg_roles WHERE rolname = current_user)
+    AND s.dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+    AND s.queryid IS NOT NULL
+GROUP BY s.queryid
+ORDER BY 4 DESC
+LIMIT %(limit)s;
+"""
+
+
+@dataclass(frozen=True, kw_only=True)
+class StatementStats:
+    """
+    Execution statistics of a statement, accumulated over one or more
+    collection intervals. `total_time` is in milliseconds and `io_blocks`
+    counts the shared, local and temporary blocks read and written.
+    """
+
+    queryid: int
+    query: str
+    calls: int
+    total_time: float
+    rows: int
+    io_blocks: int
+
+
+class ApplipyPgCollectorHandle(Protocol):
+    async def start(self) -> None:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+def _sum_stats(stats: StatementStats, other: StatementStats) -> StatementStats:
+    return StatementStats(
+        queryid=stats.queryid,
+        query=stats.query,
+        calls=stats.calls + other.calls,
+        total_time=stats.total_time + other.total_time,
+        rows=stats.rows + other.rows,
+        io_blocks=stats.io_blocks + other.io_blocks,
+    )
+
+
+def _diff_stats(stats: StatementStats, previous: StatementStats) -> StatementStats:
+    return StatementStats(
+        queryid=stats.queryid,
+        query=stats.query,
+        calls=stats.calls - previous.calls,
+        total_time=stats.total_time - previous.total_time,
+        rows=stats.rows - previous.rows,
+        io_blocks=stats.io_blocks - previous.io_blocks,
+    )
+
+
+class PgStatementsCollector:
+    """
+    Periodically reads `pg_stat_statements` for the role and database of a
+    pool and keeps the difference between consecutive snapshots, so that
+    the statements consuming the most database time can be inspected:
+
+        collector: PgStatementsCollector
+        for stats in collector.top(5, by="calls"):
+            print(stats.calls, stats.total_time, stats.query)
+
+    The snapshots are read every `interval` seconds through a dedicated
+    connection, opened with `PgPool.connect()`, so that the collector never
+    waits for, nor holds, a connection of the pool. Only the `max_statements`
+    statements with the highest total time are read from every snapshot and
+    the differences of the last `history` intervals are kept in memory.
+    Unless `log` is disabled, the `top_n` statements by total time, calls and
+    I/O of every interval are logged.
+
+    Requires the `pg_stat_statements` extension to be installed in the
+    database. The collector stops, logging a warning, if it is not.
+    """
+
+    def __init__(
+        self,
+        pool: PgPool,
+        *,
+        interval: float = 60.0,
+        top_n: int = 10,
+        max_statements: int = 500,
+        history: int = 1,
+        log: bool = True,
+    ) -> None:
+        if type(interval) not in (int, float) or interval <= 0:
+            raise ValueError(f"Invalid interval, must be a positive number: {interval!r}")
+        if type(top_n) is not int or top_n < 1:
+            raise ValueError(f"Invalid top_n, must be a positive integer: {top_n!r}")
+        if type(max_statements) is not int or max_statements < top_n:
+            raise ValueError(
+                f"Invalid max_statements, must be an integer not lower than top_n: {max_statements!r}"
+            )
+        if type(history) is not int or history < 1:
+            raise ValueError(f"Invalid history, must be a positive integer: {history!r}")
+        if type(log) is not bool:
+            raise ValueError(f"Invalid log, must be a boolean: {log!r}")
+        self._pool = pool
+        self._interval = interval
+        self._top_n = top_n
+        self._max_statements = max_statements
+        self._log = log
+        self._snapshot: dict[int, StatementStats] | None = None
+        self._snapshot_is_complete = False
+        self._deltas: deque[dict[int, StatementStats]] = deque(maxlen=history)
+        self._conn: Connection | None = None
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self) -> None:
+        """Starts collecting snapshots in the background."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stops collecting snapshots and closes the side connection."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._close_connection()
+
+    async def collect(self) -> list[StatementStats]:
+        """
+        Reads a snapshot and returns the statements executed since the
+        previous one. The first snapshot only sets the baseline.
+        """
+        snapshot = await self._read_snapshot()
+        is_complete = len(snapshot) < self._max_statements
+        previous, previous_is_complete = self._snapshot, self._snapshot_is_complete
+        self._snapshot, self._snapshot_is_complete = snapshot, is_complete
+        if previous is None:
+            return []
+        deltas: dict[int, StatementStats] = {}
+        for queryid, stats in snapshot.items():
+            previous_stats = previous.get(queryid)
+            if previous_stats is None:
+                if not previous_is_complete:
+                    # It may have been left out of the previous snapshot, so
+                    # its counters cannot be attributed to this interval.
+                    continue
+                delta = stats
+            elif stats.calls < previous_stats.calls:
+                # The statistics were reset or the entry was evicted
+                delta = stats
+            else:
+                delta = _diff_stats(stats, previous_stats)
+            if delta.calls > 0:
+                deltas[queryid] = delta
+        self._deltas.append(deltas)
+        return list(deltas.values())
+
+    def top(
+        self,
+        n: int | None = None,
+        *,
+        by: str = "total_time",
+        intervals: int | None = None,
+    ) -> list[StatementStats]:
+        """
+        Returns the `n` (by default, `top_n`) statements with the highest
+        `total_time`, `calls` or `io_blocks`, accumulated over the last
+        `intervals` collected intervals (by default, all the kept ones).
+        """
+        if by not in _SORT_KEYS:
+            raise ValueError(f"Invalid by, must be one of {', '.join(_SORT_KEYS)}: {by!r}")
+        if intervals is not None and (type(intervals) is not int or intervals < 1):
+            raise ValueError(f"Invalid intervals, must be a positive integer: {intervals!r}")
+        kept = list(self._deltas)
+        if intervals is not None:
+            kept = kept[-intervals:]
+        totals: dict[int, StatementStats] = {}
+        for deltas in kept:
+            for queryid, stats in deltas.items():
+                total = totals.get(queryid)
+                totals[queryid] = stats if total is None else _sum_stats(total, stats)
+        return sorted(totals.values(), key=lambda stats: getattr(stats, by), reverse=True)[
+            : self._top_n if n is None else n
+        ]
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.collect()
+            except UndefinedTable:
+                _logger.warning(
+                    "pg_stat_statements is not available in database `%s`, stopping the statements collector",
+                    self._pool.connection.dbname,
+                )
+                await self._close_connection()
+                return
+            except Exception:
+                _logger.exception("Failed to collect pg_stat_statements")
+                await self._close_connection()
+            else:
+                if self._log and self._deltas:
+                    self._log_top()
+            await asyncio.sleep(self._interval)
+
+    async def _read_snapshot(self) -> dict[int, StatementStats]:
+        if self._conn is None or self._conn.closed:
+            self._conn = await self._pool.connect()
+        async with self._conn.cursor() as cur:
+            await cur.execute(_SNAPSHOT_QUERY, {"limit": self._max_statements})
+            rows: Sequence[tuple[Any, ...]] = await cur.fetchall()
+        return {
+            queryid: StatementStats(
+                queryid=queryid,
+                query=query,
+                calls=calls,
+                total_time=total_time,
+                rows=rows_count,
+                io_blocks=io_blocks,
+            )
+            for queryid, query, calls, total_time, rows_count, io_blocks in rows
+        }
+
+    async def _close_connection(self) -> None:
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await conn.close()
+
+    def _log_top(self) -> None:
+        for by in _SORT_KEYS:
+            top = self.top(by=by, intervals=1)
+            if not top:
+                continue
+            _logger.info(
+                "Top %i statements by %s in `%s` over the last %gs:\n%s",
+                len(top),
+                by,
+                self._pool.connection.name or self._pool.connection.dbname,
+                self._interval,
+                "\n".join(
+                    f"  calls={stats.calls} total_time={stats.total_time:.1f}ms"
+                    f" rows={stats.rows} io_blocks={stats.io_blocks}"
+                    f" query={stats.query[:_LOGGED_QUERY_LENGTH]!r}"
+                    for stats in top
+                ),
+            )
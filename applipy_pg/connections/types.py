@@ -0,0 +1,127 @@
+import asyncio
+import weakref
+from typing import (
+    Any,
+    Sequence,
+)
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from aiopg import Connection
+
+
+_RESOLVE_TYPES_QUERY = """
+SELECT
+    t.typname,
+    n.nspname,
+    t.oid,
+    t.typarray,
+    t.typtype,
+    ARRAY(
+        SELECT ARRAY[a.attname::text, a.atttypid::text]
+        FROM pg_attribute a
+        WHERE a.attrelid = t.typrelid AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum
+    )
+FROM pg_type t JOIN pg_namespace n ON t.typnamespace = n.oid
+WHERE (%(hstore)s AND t.typname = 'hstore')
+    OR n.nspname || '.' || t.typname = ANY(%(qualified_names)s)
+    OR (t.typname = ANY(%(names)s) AND pg_type_is_visible(t.oid));
+"""
+
+
+class _ResolvedTypes:
+    def __init__(self, rows: Sequence[tuple[Any, ...]]) -> None:
+        self.hstore_oids: list[int] = []
+        self.hstore_array_oids: list[int] = []
+        self.typecasters: list[Any] = []
+        self.names: set[str] = set()
+        for name, schema, oid, array_oid, kind, attributes in rows:
+            self.names.update((name, f"{schema}.{name}"))
+            if name == "hstore":
+                self.hstore_oids.append(oid)
+                self.hstore_array_oids.append(array_oid)
+            elif kind == "c":
+                caster = psycopg2.extras.CompositeCaster(
+                    name,
+                    oid,
+                    [(attribute_name, int(attribute_oid)) for attribute_name, attribute_oid in attributes],
+                    array_oid=array_oid,
+                    schema=schema,
+                )
+                self.typecasters.append(caster.typecaster)
+                self.typecasters.append(caster.array_typecaster)
+            elif kind == "e":
+                self.typecasters.append(
+                    psycopg2.extensions.new_array_type((array_oid,), f"{name.upper()}ARRAY", psycopg2.STRING)
+                )
+
+
+class TypeCache:
+    """
+    Resolves the OIDs of the hstore type and of the given composite and enum
+    types once, with a single catalog query, and registers their
+    typecasters on every connection from the cache.
+
+    It replaces the catalog lookup aiopg runs on every new connection when
+    `enable_hstore` is set. The types in `type_names`, and hstore if
+    `hstore_required`, that are not found, i.e. because they are created by
+    migrations, are looked up again on the next connection. Call
+    `invalidate()` after the types change, so that they are resolved again.
+    """
+
+    def __init__(self, *, hstore: bool, type_names: Sequence[str], hstore_required: bool = False) -> None:
+        self._hstore = hstore
+        self._hstore_required = hstore_required
+        self._names = [name for name in type_names if "." not in name]
+        self._qualified_names = [name for name in type_names if "." in name]
+        self._resolved: _ResolvedTypes | None = None
+        # asyncio locks are bound to an event loop, so there is one per loop
+        self._locks: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @property
+    def is_needed(self) -> bool:
+        return self._hstore or bool(self._names or self._qualified_names)
+
+    def invalidate(self) -> None:
+        self._resolved = None
+
+    async def register(self, conn: Connection) -> None:
+        resolved = self._resolved
+        if resolved is None:
+            lock = self._locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+            async with lock:
+                resolved = self._resolved
+                if resolved is None:
+                    resolved = await self._resolve(conn)
+                    if self._is_complete(resolved):
+                        self._resolved = resolved
+        raw_conn = conn.raw
+        if resolved.hstore_oids:
+            psycopg2.extras.register_hstore(
+                raw_conn,
+                oid=tuple(resolved.hstore_oids),
+                array_oid=tuple(resolved.hstore_array_oids),
+            )
+        for typecaster in resolved.typecasters:
+            psycopg2.extensions.register_type(typecaster, raw_conn)
+
+    def _is_complete(self, resolved: _ResolvedTypes) -> bool:
+        if self._hstore_required and not resolved.hstore_oids:
+            return False
+        return all(name in resolved.names for name in (*self._names, *self._qualified_names))
+
+    async def _resolve(self, conn: Connection) -> _ResolvedTypes:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                _RESOLVE_TYPES_QUERY,
+                {
+                    "hstore": self._hstore,
+                    "names": self._names,
+                    "qualified_names": self._qualified_names,
+                },
+            )
+            return _ResolvedTypes(await cur.fetchall())
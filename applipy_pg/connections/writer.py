@@ -0,0 +1,227 @@
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from typing import (
+    Any,
+    Protocol,
+    Sequence,
+)
+
+import psycopg2
+from psycopg2 import sql
+
+from .pool_handle import PgPool
+
+
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+_OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST)
+
+_logger = logging.getLogger(__name__)
+
+_Target = tuple[str, tuple[str, ...]]
+_Row = tuple[_Target, Sequence[Any]]
+
+# Errors after which the same rows may be inserted successfully later, i.e.
+# when the connection is lost or the statement is canceled
+_TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class ApplipyPgWriterHandle(Protocol):
+    async def close(self) -> None:
+        ...
+
+
+class PgBufferedWriter:
+    """
+    Buffers rows in memory and inserts them in the background, so that
+    writing a row does not have to wait for a connection or a round-trip:
+
+        writer: PgBufferedWriter
+        writer.write_nowait("audit_events", ("user_id", "action"), (user_id, "login"))
+
+    The buffered rows are flushed with one multi-row `INSERT` per table when
+    `flush_rows` rows are buffered or, at the latest, every `flush_interval`
+    seconds. At most `max_rows` rows are kept in memory. When the buffer is
+    full, `write_nowait()` drops either the new row (`drop-newest`) or the
+    oldest buffered row (`drop-oldest`), according to `overflow`, while
+    `write()` waits until there is room.
+
+    Rows that fail to be inserted because of a transient error, like a lost
+    connection, are kept and retried on the next flush. When the database
+    rejects a batch, i.e. because of a constraint violation, it is split to
+    isolate the offending rows, which are logged, counted in
+    `rejected_rows` and dropped, while the rest are inserted. Buffered rows
+    are flushed when the writer is closed, on application shutdown.
+    """
+
+    def __init__(
+        self,
+        pool: PgPool,
+        *,
+        flush_rows: int = 1000,
+        flush_interval: float = 1.0,
+        max_rows: int = 100_000,
+        overflow: str = DROP_NEWEST,
+    ) -> None:
+        if type(flush_rows) is not int or flush_rows < 1:
+            raise ValueError(f"Invalid flush_rows, must be a positive integer: {flush_rows!r}")
+        if type(flush_interval) not in (int, float) or flush_interval <= 0:
+            raise ValueError(f"Invalid flush_interval, must be a positive number: {flush_interval!r}")
+        if type(max_rows) is not int or max_rows < flush_rows:
+            raise ValueError(f"Invalid max_rows, must be an integer not lower than flush_rows: {max_rows!r}")
+        if overflow not in _OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow, must be one of {', '.join(_OVERFLOW_POLICIES)}: {overflow!r}")
+        self._pool = pool
+        self._flush_rows = flush_rows
+        self._flush_interval = flush_interval
+        self._max_rows = max_rows
+        self._overflow = overflow
+        self._rows: deque[_Row] = deque()
+        self._flush_requested = asyncio.Event()
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task[None] | None = None
+        self._closed = False
+        self.dropped_rows = 0
+        self.rejected_rows = 0
+
+    def write_nowait(self, table: str, columns: Sequence[str], row: Sequence[Any]) -> bool:
+        """
+        Buffers a row to be inserted into the given columns of the table.
+        Returns `False` if the row was dropped because the buffer is full.
+        """
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed PgBufferedWriter")
+        if len(columns) != len(row):
+            raise ValueError(f"Row has {len(row)} values for {len(columns)} columns")
+        self._start()
+        if len(self._rows) >= self._max_rows:
+            self.dropped_rows += 1
+            if self._overflow == DROP_NEWEST:
+                return False
+            self._rows.popleft()
+        self._rows.append(((table, tuple(columns)), row))
+        self._on_rows_changed()
+        return True
+
+    async def write(self, table: str, columns: Sequence[str], row: Sequence[Any]) -> None:
+        """
+        Buffers a row like `write_nowait()`, waiting for buffered rows to be
+        flushed if the buffer is full.
+        """
+        while len(self._rows) >= self._max_rows and not self._closed:
+            await self._has_room.wait()
+        self.write_nowait(table, columns, row)
+
+    async def flush(self) -> None:
+        """Inserts all the buffered rows, in batches of up to `flush_rows`."""
+        async with self._flush_lock:
+            while self._rows:
+                batch = [self._rows.popleft() for _ in range(min(self._flush_rows, len(self._rows)))]
+                self._on_rows_changed()
+                # Stack of the parts of the batch still to be inserted, the
+                # next one last
+                pending = [batch]
+                try:
+                    while pending:
+                        await self._insert_rejecting(pending)
+                except BaseException:
+                    # Keep the rows that could not be inserted ahead of the
+                    # ones buffered in the meantime, dropping the oldest ones
+                    # that do not fit.
+                    self._rows.extendleft(row for rows in pending for row in reversed(rows))
+                    while len(self._rows) > self._max_rows:
+                        self._rows.popleft()
+                        self.dropped_rows += 1
+                    self._on_rows_changed()
+                    raise
+
+    async def close(self) -> None:
+        """Stops the background flushing and flushes the buffered rows."""
+        self._closed = True
+        self._has_room.set()
+        if self._task is not None:
+            # Wait for an ongoing flush, so that it is not cancelled halfway
+            async with self._flush_lock:
+                self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            _logger.exception("Failed to flush %i buffered rows on close, they are lost", len(self._rows))
+
+    def _start(self) -> None:
+        if self._task is None:
+            # Started from the first write, so it must not inherit the
+            # writer's context, i.e. its deadline or scoped settings
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    def _on_rows_changed(self) -> None:
+        if len(self._rows) >= self._flush_rows:
+            self._flush_requested.set()
+        if len(self._rows) < self._max_rows:
+            self._has_room.set()
+        else:
+            self._has_room.clear()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                _logger.exception("Failed to flush %i buffered rows", len(self._rows))
+                await asyncio.sleep(self._flush_interval)
+
+    async def _insert_rejecting(self, pending: list[list[_Row]]) -> None:
+        """
+        Inserts the last rows of `pending`, removing them once inserted. If
+        the database rejects them, they are replaced by their two halves, or
+        dropped if it is a single row.
+        """
+        rows = pending[-1]
+        try:
+            await self._insert(rows)
+        except psycopg2.Error as e:
+            if isinstance(e, _TRANSIENT_ERRORS):
+                raise
+            pending.pop()
+            if len(rows) == 1:
+                (table, _), _ = rows[0]
+                self.rejected_rows += 1
+                _logger.error("Dropping row rejected by the database for table `%s`: %s", table, e)
+            else:
+                middle = len(rows) // 2
+                pending.extend((rows[middle:], rows[:middle]))
+        else:
+            pending.pop()
+
+    async def _insert(self, rows: list[_Row]) -> None:
+        rows_by_target: dict[_Target, list[Sequence[Any]]] = {}
+        for target, row in rows:
+            rows_by_target.setdefault(target, []).append(row)
+        query_parts: list[sql.Composable] = []
+        params: list[Any] = []
+        for (table, columns), target_rows in rows_by_target.items():
+            placeholders = sql.SQL("({})").format(sql.SQL(", ").join([sql.Placeholder()] * len(columns)))
+            query_parts.append(
+                sql.SQL("INSERT INTO {} ({}) VALUES {};").format(
+                    sql.Identifier(*table.split(".")),
+                    sql.SQL(", ").join(map(sql.Identifier, columns)),
+                    sql.SQL(", ").join([placeholders] * len(target_rows)),
+                )
+            )
+            for row in target_rows:
+                params.extend(row)
+        async with self._pool.cursor() as cur:
+            # All the inserts are sent in a single query, so they are
+            # executed in the same implicit transaction.
+            await cur.execute(sql.Composed(query_parts), params)
@@ -1,14 +1,24 @@
 from .migration import (
+    PgBackgroundMigration,
     PgClassNameMigration,
     PgMigration,
     find_migrations,
+    get_replication_lag,
 )
 from .module import PgMigrationsModule
+from .repository import (
+    MigrationExecution,
+    Repository,
+)
 
 
 __all__ = [
+    "MigrationExecution",
+    "PgBackgroundMigration",
     "PgClassNameMigration",
     "PgMigration",
     "PgMigrationsModule",
+    "Repository",
     "find_migrations",
+    "get_replication_lag",
 ]
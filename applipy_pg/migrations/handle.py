@@ -1,9 +1,42 @@
+import asyncio
+import datetime
+import random
+import socket
+import time
 from logging import Logger
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Sequence,
+    TypeVar,
+    cast,
+)
 
 from applipy import AppHandle
+from psycopg2.errors import LockNotAvailable
 
-from .migration import PgMigration
-from .repository import Repository
+from applipy_pg import scoped_settings
+
+from .migration import (
+    PgBackgroundMigration,
+    PgMigration,
+)
+from .options import MigrationsOptions
+from .repository import (
+    MigrationExecution,
+    Repository,
+)
+
+
+_T = TypeVar("_T")
+
+
+class _Timing:
+    def __init__(self) -> None:
+        self.started_at = datetime.datetime.now(datetime.UTC)
+        self.execution = 0.0
+        self.lock_wait = 0.0
 
 
 class _DummyMigration(PgMigration):
@@ -30,29 +63,179 @@ def _get_migrations_by_subject(
     return migrations_by_subject
 
 
+def _sort_subjects_by_dependencies(
+    subjects: list[str], subject_dependencies: dict[str, list[str]]
+) -> list[str]:
+    sorted_subjects: list[str] = []
+    visited: set[str] = set()
+    visiting: set[str] = set()
+
+    def visit(subject: str) -> None:
+        if subject in visited:
+            return
+        if subject in visiting:
+            raise ValueError(f"Circular dependency between migration subjects involving {subject}")
+        visiting.add(subject)
+        for dependency in subject_dependencies.get(subject, []):
+            if dependency in subjects:
+                visit(dependency)
+        visiting.remove(subject)
+        visited.add(subject)
+        sorted_subjects.append(subject)
+
+    for subject in subjects:
+        visit(subject)
+    return sorted_subjects
+
+
 class MigrationsHandle(AppHandle):
     def __init__(
-        self, migrations: list[PgMigration], repository: Repository, logger: Logger
+        self,
+        migrations: list[PgMigration],
+        repository: Repository,
+        logger: Logger,
+        options: MigrationsOptions | None,
     ) -> None:
-        self._migrations_by_subject = _get_migrations_by_subject(migrations)
+        migrations_by_subject = _get_migrations_by_subject(migrations)
+        self._migrations_by_subject: dict[str, list[PgMigration]] = {}
+        self._background_migrations_by_subject: dict[str, list[PgBackgroundMigration]] = {}
+        for subject, subject_migrations in migrations_by_subject.items():
+            background_migrations = [
+                migration
+                for migration in subject_migrations
+                if isinstance(migration, PgBackgroundMigration)
+            ]
+            if not background_migrations:
+                self._migrations_by_subject[subject] = subject_migrations
+            elif len(background_migrations) == len(subject_migrations):
+                self._background_migrations_by_subject[subject] = background_migrations
+            else:
+                raise ValueError(
+                    f"Subject {subject} mixes background and regular migrations"
+                )
         self._repository = repository
         self._logger = logger.getChild(f"{self.__module__}.{self.__class__.__name__}")
+        self._options = options or MigrationsOptions()
+        self._subjects = _sort_subjects_by_dependencies(
+            list(self._migrations_by_subject), self._options.subject_dependencies
+        )
+        self._background_task: asyncio.Task[None] | None = None
+        self._host = socket.gethostname()
 
     async def on_init(self) -> None:
-        for subject in self._migrations_by_subject:
+        if not self._subjects:
+            return
+
+        # Other instances of the application may be running the same
+        # migrations, so the state is only read once the lock is held.
+        async with self._repository.lock(self._options.advisory_lock_timeout):
+            await self._run_migrations()
+        # The migrations may have created or changed the pool's types
+        await self._repository.pool.refresh_types()
+
+    async def on_start(self) -> None:
+        if self._background_migrations_by_subject:
+            self._background_task = asyncio.create_task(
+                self._run_background_migrations()
+            )
+
+    async def on_shutdown(self) -> None:
+        if self._background_task is not None:
+            self._background_task.cancel()
+            await asyncio.gather(self._background_task, return_exceptions=True)
+
+    async def _run_migrations(self) -> None:
+        latest_versions = await self._repository.get_latest_versions()
+        executed_versions: dict[str, str] = {}
+        executions: list[MigrationExecution] = []
+        semaphore = asyncio.Semaphore(self._options.concurrency)
+        if self._options.concurrency == 1:
+            # Subjects are sorted by their dependencies, so running them in
+            # order stops at the first failure, like before concurrency.
+            try:
+                for subject in self._subjects:
+                    await self._migrate_subject(
+                        subject,
+                        latest_versions.get(subject),
+                        executed_versions,
+                        executions,
+                        [],
+                        semaphore,
+                    )
+            finally:
+                await self._repository.set_latest_versions(executed_versions, executions)
+            return
+
+        tasks: dict[str, asyncio.Task[None]] = {}
+        for subject in self._subjects:
+            dependencies = [
+                tasks[dependency]
+                for dependency in self._options.subject_dependencies.get(subject, [])
+                if dependency in tasks
+            ]
+            tasks[subject] = asyncio.create_task(
+                self._migrate_subject(
+                    subject,
+                    latest_versions.get(subject),
+                    executed_versions,
+                    executions,
+                    dependencies,
+                    semaphore,
+                )
+            )
+
+        try:
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        finally:
+            await self._repository.set_latest_versions(executed_versions, executions)
+
+        errors: list[Exception] = []
+        for subject, result in zip(tasks, results):
+            if isinstance(result, BaseException):
+                if not isinstance(result, Exception):
+                    raise result
+                self._logger.error("Migrations for %s failed: %r", subject, result)
+                result.add_note(f"Migration subject: {subject}")
+                errors.append(result)
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            raise ExceptionGroup("Migrations failed", errors)
+
+    async def _migrate_subject(
+        self,
+        subject: str,
+        latest_version: str | None,
+        executed_versions: dict[str, str],
+        executions: list[MigrationExecution],
+        dependencies: list["asyncio.Task[None]"],
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        for dependency in dependencies:
+            try:
+                await asyncio.shield(dependency)
+            except Exception as e:
+                raise RuntimeError(f"Not migrating {subject}: a subject it depends on failed") from e
+
+        async with semaphore:
             self._logger.debug("Starting migrations for %s", subject)
-            migrations_to_execute = await self._get_migrations_to_execute(subject)
+            migrations_to_execute = self._get_migrations_to_execute(
+                subject, self._migrations_by_subject[subject], latest_version
+            )
             if migrations_to_execute:
-                await self._execute_migrations(migrations_to_execute)
+                await self._execute_migrations(migrations_to_execute, executed_versions, executions)
             else:
                 self._logger.debug("No migrations to execute for %s", subject)
 
-    async def _get_migrations_to_execute(self, subject: str) -> list[PgMigration]:
-        migrations = self._migrations_by_subject.get(subject, [])
-        latest_version = await self._repository.get_latest_version(subject)
+    def _get_migrations_to_execute(
+        self,
+        subject: str,
+        migrations: Sequence[PgMigration],
+        latest_version: str | None,
+    ) -> list[PgMigration]:
         self._logger.debug("Latest version for %s is %s", subject, latest_version)
         if latest_version is None:
-            return migrations
+            return list(migrations)
         else:
             dummy_latest_migration = _DummyMigration(subject, latest_version)
             return [
@@ -61,7 +244,12 @@ class MigrationsHandle(AppHandle):
                 if dummy_latest_migration < migration
             ]
 
-    async def _execute_migrations(self, migrations: list[PgMigration]) -> None:
+    async def _execute_migrations(
+        self,
+        migrations: list[PgMigration],
+        executed_versions: dict[str, str],
+        executions: list[MigrationExecution],
+    ) -> None:
         if not migrations:
             return
 
@@ -75,8 +263,22 @@ class MigrationsHandle(AppHandle):
                     subject,
                     migration.version(),
                 )
-                await migration.migrate()
+                timing = _Timing()
+                try:
+                    await self._run_with_timeouts(migration, migration.migrate, timing)
+                except Exception as e:
+                    executions.append(self._get_execution(migration, timing, e))
+                    raise
+                executions.append(self._get_execution(migration, timing))
+                self._logger.info(
+                    "Executed migration for %s version %s in %.3f seconds, waited %.3f seconds for locks",
+                    subject,
+                    migration.version(),
+                    timing.execution,
+                    timing.lock_wait,
+                )
                 latest_success_version = migration.version()
+                executed_versions[subject] = latest_success_version
         finally:
             if latest_success_version is not None:
                 self._logger.info(
@@ -84,6 +286,157 @@ class MigrationsHandle(AppHandle):
                     subject,
                     latest_success_version,
                 )
-                await self._repository.set_latest_version(
-                    subject, latest_success_version
+
+    def _get_execution(
+        self, migration: PgMigration, timing: _Timing, error: Exception | None = None
+    ) -> MigrationExecution:
+        return MigrationExecution(
+            subject=migration.subject(),
+            version=migration.version(),
+            started_at=timing.started_at,
+            duration_seconds=timing.execution + timing.lock_wait,
+            lock_wait_seconds=timing.lock_wait,
+            succeeded=error is None,
+            error=None if error is None else f"{type(error).__name__}: {error}",
+            host=self._host,
+            app_version=self._options.app_version,
+            background=isinstance(migration, PgBackgroundMigration),
+        )
+
+    async def _run_with_timeouts(
+        self, migration: PgMigration, step: Callable[[], Awaitable[_T]], timing: _Timing
+    ) -> _T:
+        """
+        Runs a step of the migration with its lock and statement timeouts,
+        retrying it with exponential backoff when it times out waiting for a
+        lock. The time spent in attempts that timed out waiting for a lock,
+        and in the backoff, is added to the lock wait of `timing`, and the
+        rest to its execution.
+        """
+        lock_timeout = migration.lock_timeout() or self._options.lock_timeout
+        statement_timeout = migration.statement_timeout() or self._options.statement_timeout
+        settings: dict[str, Any] = {}
+        if lock_timeout is not None:
+            settings["lock_timeout"] = f"{int(lock_timeout * 1000)}ms"
+        if statement_timeout is not None:
+            settings["statement_timeout"] = f"{int(statement_timeout * 1000)}ms"
+
+        attempt = 0
+        with scoped_settings(settings):
+            while True:
+                start = time.monotonic()
+                try:
+                    result = await step()
+                except LockNotAvailable:
+                    timing.lock_wait += time.monotonic() - start
+                    if attempt >= self._options.lock_retries:
+                        raise
+                    backoff = self._options.lock_retry_backoff * 2 ** attempt
+                    backoff *= random.uniform(0.5, 1.0)
+                    attempt += 1
+                    self._logger.warning(
+                        "Migration for %s version %s timed out waiting for a lock, retrying in %.3f seconds (%i/%i)",
+                        migration.subject(),
+                        migration.version(),
+                        backoff,
+                        attempt,
+                        self._options.lock_retries,
+                    )
+                    await asyncio.sleep(backoff)
+                    timing.lock_wait += backoff
+                    continue
+                except BaseException:
+                    timing.execution += time.monotonic() - start
+                    raise
+                timing.execution += time.monotonic() - start
+                return result
+
+    async def _run_background_migrations(self) -> None:
+        if not self._subjects:
+            # The tables were not created under the lock by on_init, and
+            # other instances may be creating them at the same time.
+            try:
+                async with self._repository.lock(self._options.advisory_lock_timeout):
+                    await self._repository.ensure_table_exists()
+            except Exception:
+                self._logger.exception("Failed to create the migrations tables, skipping background migrations")
+                return
+        semaphore = asyncio.Semaphore(self._options.concurrency)
+        await asyncio.gather(
+            *(
+                self._run_background_subject(subject, migrations, semaphore)
+                for subject, migrations in self._background_migrations_by_subject.items()
+            )
+        )
+
+    async def _run_background_subject(
+        self,
+        subject: str,
+        migrations: list[PgBackgroundMigration],
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        async with semaphore, self._repository.try_lock_subject(subject) as acquired:
+            if not acquired:
+                self._logger.info(
+                    "Background migrations for %s are being executed by another instance",
+                    subject,
                 )
+                return
+            try:
+                latest_version = await self._repository.get_latest_version(subject)
+                migrations_to_execute = self._get_migrations_to_execute(
+                    subject, migrations, latest_version
+                )
+                for migration in sorted(migrations_to_execute):
+                    await self._execute_background_migration(cast(PgBackgroundMigration, migration))
+            except Exception:
+                self._logger.exception("Background migrations for %s failed", subject)
+
+    async def _execute_background_migration(self, migration: PgBackgroundMigration) -> None:
+        subject = migration.subject()
+        version = migration.version()
+        checkpoint = await self._repository.get_checkpoint(subject, version)
+        self._logger.info(
+            "Executing background migration for %s version %s from checkpoint %s",
+            subject,
+            version,
+            checkpoint,
+        )
+        batch_size = migration.batch_size()
+        batch_pause = migration.batch_pause()
+        max_replication_lag = migration.max_replication_lag()
+        timing = _Timing()
+        try:
+            while True:
+                if max_replication_lag is not None:
+                    while (lag := await migration.replication_lag()) > max_replication_lag:
+                        self._logger.debug(
+                            "Replication lag is %.3f seconds, pausing background migration for %s version %s",
+                            lag,
+                            subject,
+                            version,
+                        )
+                        await asyncio.sleep(max(batch_pause, 1.0))
+                after = checkpoint
+                checkpoint = await self._run_with_timeouts(
+                    migration, lambda: migration.migrate_chunk(after, batch_size), timing
+                )
+                if checkpoint is None:
+                    break
+                await self._repository.set_checkpoint(subject, version, checkpoint)
+                if batch_pause > 0:
+                    await asyncio.sleep(batch_pause)
+        except Exception as e:
+            await self._repository.set_latest_versions({}, [self._get_execution(migration, timing, e)])
+            raise
+
+        await self._repository.set_latest_versions(
+            {subject: version}, [self._get_execution(migration, timing)]
+        )
+        self._logger.info(
+            "Background migration for %s version %s completed in %.3f seconds, waited %.3f seconds for locks",
+            subject,
+            version,
+            timing.execution,
+            timing.lock_wait,
+        )
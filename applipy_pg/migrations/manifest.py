@@ -0,0 +1,186 @@
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import pkgutil
+from typing import (
+    Any,
+    cast,
+)
+
+from applipy_inject.inject import Injector
+
+from .migration import (
+    PgBackgroundMigration,
+    PgMigration,
+    find_migrations,
+)
+
+
+_MANIFEST_FORMAT_VERSION = 1
+
+_logger = logging.getLogger(__name__)
+
+
+class _LazyMigration(PgMigration):
+    """
+    Migration whose subject and version are known from the manifest, and
+    whose module is only imported when it has to be executed.
+    """
+
+    def __init__(
+        self,
+        subject: str,
+        version: str,
+        module_name: str,
+        class_name: str,
+        injector: Injector,
+    ) -> None:
+        self._subject = subject
+        self._version = version
+        self._module_name = module_name
+        self._class_name = class_name
+        self._injector = injector
+        self._migration: PgMigration | None = None
+
+    async def migrate(self) -> None:
+        await self._get_migration().migrate()
+
+    def subject(self) -> str:
+        return self._subject
+
+    def version(self) -> str:
+        return self._version
+
+    def lock_timeout(self) -> float | None:
+        return self._get_migration().lock_timeout()
+
+    def statement_timeout(self) -> float | None:
+        return self._get_migration().statement_timeout()
+
+    def _get_migration(self) -> PgMigration:
+        if self._migration is None:
+            module = importlib.import_module(self._module_name)
+            migration_class: type[PgMigration] = getattr(module, self._class_name)
+            self._injector.bind(migration_class)
+            self._migration = self._injector.get(migration_class)
+        return self._migration
+
+
+class _LazyBackgroundMigration(_LazyMigration, PgBackgroundMigration):
+    async def migrate_chunk(self, after: str | None, batch_size: int) -> str | None:
+        return await self._get_background_migration().migrate_chunk(after, batch_size)
+
+    def batch_size(self) -> int:
+        return self._get_background_migration().batch_size()
+
+    def batch_pause(self) -> float:
+        return self._get_background_migration().batch_pause()
+
+    def max_replication_lag(self) -> float | None:
+        return self._get_background_migration().max_replication_lag()
+
+    async def replication_lag(self) -> float:
+        return await self._get_background_migration().replication_lag()
+
+    def _get_background_migration(self) -> PgBackgroundMigration:
+        return cast(PgBackgroundMigration, self._get_migration())
+
+
+def _get_module_files(module_name: str) -> dict[str, list[Any]]:
+    module = importlib.import_module(module_name)
+    files: dict[str, list[Any]] = {}
+    for module_info in pkgutil.iter_modules(module.__path__):
+        submodule_name = f"{module.__name__}.{module_info.name}"
+        spec = importlib.util.find_spec(submodule_name)
+        origin = spec.origin if spec is not None else None
+        if origin is not None and os.path.isfile(origin):
+            stat = os.stat(origin)
+            files[submodule_name] = [origin, stat.st_mtime_ns, stat.st_size]
+        else:
+            files[submodule_name] = [origin, None, None]
+    return files
+
+
+def _describe_migration(migration_class: type[PgMigration]) -> dict[str, Any] | None:
+    try:
+        # subject() and version() are read without calling the constructor,
+        # that may require dependencies
+        migration = migration_class.__new__(migration_class)
+        return {
+            "subject": migration.subject(),
+            "version": migration.version(),
+            "module": migration_class.__module__,
+            "class_name": migration_class.__qualname__,
+            "background": issubclass(migration_class, PgBackgroundMigration),
+        }
+    except Exception:
+        return None
+
+
+def _read_manifest(path: str) -> dict[str, Any]:
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("format") != _MANIFEST_FORMAT_VERSION:
+        return {}
+    modules = manifest.get("modules")
+    return modules if isinstance(modules, dict) else {}
+
+
+def _write_manifest(path: str, modules: dict[str, Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"format": _MANIFEST_FORMAT_VERSION, "modules": modules}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def find_migrations_with_manifest(
+    module_names: list[str], manifest_path: str, injector: Injector
+) -> list[type[PgMigration] | PgMigration]:
+    """
+    Finds the migrations in the given modules, like `find_migrations`, using a
+    manifest file to avoid importing them.
+
+    For each module, the manifest lists its migrations and the modification
+    time and size of its submodule files. If the files did not change, lazy
+    migrations are returned that only import their module when executed.
+    Otherwise, the module is scanned and the manifest is rewritten, if
+    possible.
+    """
+    manifest = _read_manifest(manifest_path)
+    updated_manifest: dict[str, Any] = {}
+    migrations: list[type[PgMigration] | PgMigration] = []
+    for module_name in module_names:
+        files = _get_module_files(module_name)
+        cached = manifest.get(module_name)
+        if isinstance(cached, dict) and cached.get("files") == files:
+            updated_manifest[module_name] = cached
+            migrations.extend(
+                (_LazyBackgroundMigration if entry.get("background") else _LazyMigration)(
+                    entry["subject"],
+                    entry["version"],
+                    entry["module"],
+                    entry["class_name"],
+                    injector,
+                )
+                for entry in cached["migrations"]
+            )
+            continue
+
+        migration_classes = find_migrations(module_name)
+        migrations.extend(migration_classes)
+        entries = [_describe_migration(migration_class) for migration_class in migration_classes]
+        if all(entry is not None for entry in entries):
+            updated_manifest[module_name] = {"files": files, "migrations": entries}
+
+    if updated_manifest != manifest:
+        try:
+            _write_manifest(manifest_path, updated_manifest)
+        except OSError:
+            # The manifest is only a cache, i.e. the filesystem may be read-only
+            _logger.warning("Failed to write the migrations manifest to %s", manifest_path, exc_info=True)
+    return migrations
@@ -4,6 +4,8 @@ import pkgutil
 from functools import total_ordering
 from typing import Any, override
 
+from applipy_pg import PgPool
+
 
 @total_ordering
 class PgMigration:
@@ -16,6 +18,21 @@ class PgMigration:
     def version(self) -> str:
         raise NotImplementedError()
 
+    def lock_timeout(self) -> float | None:
+        """
+        Seconds that the statements of the migration wait for a lock before
+        failing, retried as configured in `pg.migrations`. `None` uses
+        `pg.migrations.lock_timeout`.
+        """
+        return None
+
+    def statement_timeout(self) -> float | None:
+        """
+        Seconds that each statement of the migration may run. `None` uses
+        `pg.migrations.statement_timeout`.
+        """
+        return None
+
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, PgMigration):
             raise TypeError('Can only compare between Migrations')
@@ -33,6 +50,65 @@ class PgMigration:
         return self.version() < other.version()
 
 
+class PgBackgroundMigration(PgMigration):
+    """
+    Migration for large data changes that runs in the background once the
+    application has started, instead of blocking its initialization.
+
+    The work is split in chunks of rows identified by a key, i.e. a primary
+    key. `migrate_chunk()` processes the rows after the given key and returns
+    the key of the last row processed, or `None` when there is nothing left.
+    Progress is checkpointed after every chunk, so the migration resumes
+    where it stopped after a restart.
+    ```python
+        class Backfill_20240101(PgClassNameMigration, PgBackgroundMigration):
+            async def migrate_chunk(self, after: str | None, batch_size: int) -> str | None:
+                async with self._pool.cursor() as cur:
+                    await cur.execute(
+                        "UPDATE t SET c = ... WHERE id IN ("
+                        " SELECT id FROM t WHERE id > %s ORDER BY id LIMIT %s"
+                        ") RETURNING id",
+                        (int(after or 0), batch_size),
+                    )
+                    ids = [row[0] for row in await cur.fetchall()]
+                return str(max(ids)) if ids else None
+    ```
+
+    Subjects cannot mix background and regular migrations.
+    """
+
+    async def migrate(self) -> None:
+        after: str | None = None
+        while True:
+            after = await self.migrate_chunk(after, self.batch_size())
+            if after is None:
+                return
+
+    async def migrate_chunk(self, after: str | None, batch_size: int) -> str | None:
+        raise NotImplementedError()
+
+    def batch_size(self) -> int:
+        return 1000
+
+    def batch_pause(self) -> float:
+        """Seconds to wait between chunks."""
+        return 0.0
+
+    def max_replication_lag(self) -> float | None:
+        """
+        Seconds of replication lag above which processing is paused until the
+        replicas catch up, according to `replication_lag()`.
+        """
+        return None
+
+    async def replication_lag(self) -> float:
+        """
+        Current replication lag in seconds. Override it, i.e. using
+        `get_replication_lag()`, to throttle on `max_replication_lag()`.
+        """
+        return 0.0
+
+
 class PgClassNameMigration(PgMigration):
     """
     Utility class to create Migration classes that have their subject and
@@ -64,6 +140,19 @@ class PgClassNameMigration(PgMigration):
         return self.__class__.__name__.split('_', 2)[1]
 
 
+async def get_replication_lag(pool: PgPool) -> float:
+    """
+    Returns the replay lag, in seconds, of the most lagging replica of the
+    database the pool is connected to.
+    """
+    async with pool.cursor() as cur:
+        await cur.execute(
+            "SELECT COALESCE(EXTRACT(EPOCH FROM max(replay_lag)), 0) FROM pg_stat_replication;"
+        )
+        row = await cur.fetchone()
+    return float(row[0])
+
+
 def find_migrations(module_name: str) -> list[type[PgMigration]]:
     module = importlib.import_module(module_name)
     submodule_names = [f'{module.__name__}.{mi.name}' for mi in pkgutil.iter_modules(module.__path__)]
@@ -5,9 +5,14 @@ from applipy import (
     Module,
     RegisterFunction,
 )
-from applipy_inject.inject import with_names
+from applipy_inject.inject import (
+    Injector,
+    with_names,
+)
 
 from .handle import MigrationsHandle
+from .manifest import find_migrations_with_manifest
+from .options import MigrationsOptions
 from .repository import Repository
 from .migration import PgMigration, find_migrations
 from applipy_pg import PgModule
@@ -29,6 +34,7 @@ class PgMigrationsModule(Module):
         else:
             bind(Repository)
 
+        bind(MigrationsOptions, MigrationsOptions.from_config(self._config))
         register(MigrationsHandle)
         self._bind_migrations_from_config(bind)
 
@@ -40,10 +46,22 @@ class PgMigrationsModule(Module):
         migrations_module_names = self._config.get('modules', [])
         if type(migrations_module_names) is not list:
             raise TypeError("Config value `pg.migrations.modules` must be a list of strings or None")
-        migrations = [
-            migration
-            for migrations_module_name in migrations_module_names
-            for migration in find_migrations(migrations_module_name)
-        ]
+        manifest_path = self._config.get('manifest')
+        if manifest_path is not None and type(manifest_path) is not str:
+            raise TypeError("Config value `pg.migrations.manifest` must be a string or None")
+        # Lazy migrations are built using the injector when executed, so the
+        # manifest can only be used when binding to an injector.
+        injector = getattr(bind, '__self__', None)
+        migrations: list[type[PgMigration] | PgMigration]
+        if manifest_path and isinstance(injector, Injector):
+            migrations = find_migrations_with_manifest(
+                migrations_module_names, manifest_path, injector
+            )
+        else:
+            migrations = [
+                migration
+                for migrations_module_name in migrations_module_names
+                for migration in find_migrations(migrations_module_name)
+            ]
         for migration in migrations:
             bind(PgMigration, migration)
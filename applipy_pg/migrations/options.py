@@ -0,0 +1,92 @@
+from typing import (
+    Any,
+    Mapping,
+)
+
+
+def _validate_timeout(name: str, value: Any) -> None:
+    if value is not None and (type(value) not in (int, float) or value <= 0):
+        raise TypeError(f"Config value `pg.migrations.{name}` must be a positive number or None")
+
+
+class MigrationsOptions:
+    """
+    Options controlling how migrations are executed, read from `pg.migrations`:
+
+    - `concurrency`: maximum number of subjects migrated at the same time.
+      Migrations within a subject are always executed in order.
+    - `subject_dependencies`: mapping of subject to the list of subjects that
+      must be successfully migrated before it.
+    - `advisory_lock_timeout`: maximum number of seconds to wait for other
+      application instances that are running migrations. Waits forever if
+      not set.
+    - `lock_timeout` and `statement_timeout`: default number of seconds that
+      the statements of a migration wait for locks and run, for migrations
+      that do not declare their own. No limit if not set.
+    - `lock_retries`: number of times a migration is retried when it fails
+      because of its lock timeout.
+    - `lock_retry_backoff`: seconds to wait before the first retry, doubled
+      on every following retry.
+    - `app_version`: version of the application, recorded with every
+      migration execution.
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency: int = 1,
+        subject_dependencies: dict[str, list[str]] | None = None,
+        advisory_lock_timeout: float | None = None,
+        lock_timeout: float | None = None,
+        statement_timeout: float | None = None,
+        lock_retries: int = 0,
+        lock_retry_backoff: float = 1.0,
+        app_version: str | None = None,
+    ) -> None:
+        if type(concurrency) is not int or concurrency < 1:
+            raise TypeError("Config value `pg.migrations.concurrency` must be a positive integer")
+        if subject_dependencies is not None and not (
+            isinstance(subject_dependencies, dict)
+            and all(
+                type(subject) is str
+                and isinstance(dependencies, list)
+                and all(type(dependency) is str for dependency in dependencies)
+                for subject, dependencies in subject_dependencies.items()
+            )
+        ):
+            raise TypeError(
+                "Config value `pg.migrations.subject_dependencies` must be a mapping of strings to lists of strings"
+            )
+        _validate_timeout("advisory_lock_timeout", advisory_lock_timeout)
+        _validate_timeout("lock_timeout", lock_timeout)
+        _validate_timeout("statement_timeout", statement_timeout)
+        if type(lock_retries) is not int or lock_retries < 0:
+            raise TypeError("Config value `pg.migrations.lock_retries` must be a non-negative integer")
+        if type(lock_retry_backoff) not in (int, float) or lock_retry_backoff < 0:
+            raise TypeError("Config value `pg.migrations.lock_retry_backoff` must be a non-negative number")
+        if app_version is not None and type(app_version) is not str:
+            raise TypeError("Config value `pg.migrations.app_version` must be a string or None")
+        self.concurrency = concurrency
+        self.subject_dependencies = subject_dependencies or {}
+        self.advisory_lock_timeout = advisory_lock_timeout
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.lock_retries = lock_retries
+        self.lock_retry_backoff = lock_retry_backoff
+        self.app_version = app_version
+
+    @classmethod
+    def from_config(cls, config: Any) -> "MigrationsOptions":
+        subject_dependencies = config.get("subject_dependencies")
+        if isinstance(subject_dependencies, Mapping):
+            subject_dependencies = dict(subject_dependencies)
+        return cls(
+            concurrency=config.get("concurrency", 1),
+            subject_dependencies=subject_dependencies,
+            advisory_lock_timeout=config.get("advisory_lock_timeout"),
+            lock_timeout=config.get("lock_timeout"),
+            statement_timeout=config.get("statement_timeout"),
+            lock_retries=config.get("lock_retries", 0),
+            lock_retry_backoff=config.get("lock_retry_backoff", 1.0),
+            app_version=config.get("app_version"),
+        )
@@ -1,31 +1,222 @@
+import asyncio
 import datetime
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from logging import Logger
+from typing import (
+    Any,
+    AsyncIterator,
+    Sequence,
+)
 
 from applipy_pg import PgPool
 
 
 _REPOSITORY_TABLE_NAME = "applipy_pg_migrations_repository"
+_STATE_TABLE_NAME = "applipy_pg_migrations_state"
+_CHECKPOINTS_TABLE_NAME = "applipy_pg_migrations_checkpoints"
+_EXECUTIONS_TABLE_NAME = "applipy_pg_migrations_executions"
+_EXECUTION_COLUMNS = (
+    "subject",
+    "version",
+    "started_at",
+    "duration_seconds",
+    "lock_wait_seconds",
+    "succeeded",
+    "error",
+    "host",
+    "app_version",
+    "background",
+)
+# Key of the advisory lock that serializes migrations across instances
+_LOCK_KEY = 0x6170706c6970795f
 
 
 class Clock:
+    def utc_now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.UTC)
+
     def utc_now_as_timestamp(self) -> str:
-        return datetime.datetime.now(datetime.UTC).isoformat(timespec="milliseconds")
+        return self.utc_now().isoformat(timespec="milliseconds")
+
+
+@dataclass(frozen=True, kw_only=True)
+class MigrationExecution:
+    """
+    Record of one execution of a migration, successful or not. For
+    background migrations, it covers the run that completed or failed, from
+    the checkpoint it resumed from.
+    """
+
+    subject: str
+    version: str
+    started_at: datetime.datetime
+    duration_seconds: float
+    lock_wait_seconds: float
+    succeeded: bool
+    error: str | None
+    host: str
+    app_version: str | None
+    background: bool
 
 
 class Repository:
+    """
+    Keeps track of the executed migrations.
+
+    Every executed version is appended to the repository table, while the
+    state table holds only the latest version of each subject, so that
+    loading the state does not get slower as the history grows.
+
+    Migrations are serialized across application instances with a
+    session-level advisory lock (see `lock()`). The progress of background
+    migrations is checkpointed in the checkpoints table. Every execution of
+    a migration, including failed ones, is recorded in the executions table
+    (see `MigrationExecution`).
+    """
+
     def __init__(self, pool: PgPool, logger: Logger, clock: Clock | None) -> None:
+        if pool.connection.pooler is not None:
+            # Session-level advisory locks could be released on another
+            # server backend, leaking them
+            raise ValueError(
+                f"The migrations connection must not use a pooler, got `{pool.connection.pooler}`:"
+                " configure a direct connection to PostgreSQL in `pg.migrations.connection`"
+            )
         self._pool = pool
         self._logger = logger.getChild(f"{self.__module__}.{self.__class__.__name__}")
         self._clock = clock or Clock()
         self._has_ensured_table_exists = False
+        self._ensure_table_exists_lock = asyncio.Lock()
+
+    @property
+    def pool(self) -> PgPool:
+        return self._pool
+
+    @asynccontextmanager
+    async def lock(self, timeout: float | None = None) -> AsyncIterator[None]:
+        """
+        Holds the migrations advisory lock for the duration of the context.
+
+        The lock is taken on a dedicated connection, so it does not use one of
+        the pool's connections. If `timeout` (in seconds) is set, waiting for
+        the lock fails with `psycopg2.errors.LockNotAvailable` after that time.
+        """
+        async with self._pool.connect() as conn:
+            async with conn.cursor() as cur:
+                start = time.monotonic()
+                # Sent as a single query, so the lock_timeout is rolled back if
+                # the lock is not acquired and is reset if it is.
+                await cur.execute(
+                    """
+SET lock_timeout = %(lock_timeout)s;
+SELECT pg_advisory_lock(%(key)s);
+RESET lock_timeout;
+""",
+                    {
+                        "lock_timeout": f"{int(timeout * 1000)}ms" if timeout else "0",
+                        "key": _LOCK_KEY,
+                    },
+                )
+                self._logger.info(
+                    "Acquired migrations lock after waiting %.3f seconds",
+                    time.monotonic() - start,
+                )
+                try:
+                    yield
+                finally:
+                    if not conn.closed:
+                        await cur.execute("SELECT pg_advisory_unlock(%s);", (_LOCK_KEY,))
+
+    @asynccontextmanager
+    async def try_lock_subject(self, subject: str) -> AsyncIterator[bool]:
+        """
+        Tries to take an advisory lock specific to the subject, without
+        waiting, and holds it for the duration of the context if it was
+        acquired. Yields whether the lock was acquired.
+        """
+        async with self._pool.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT pg_try_advisory_lock(%(key)s, hashtext(%(subject)s));",
+                    {"key": _LOCK_KEY >> 32, "subject": subject},
+                )
+                row = await cur.fetchone()
+                acquired: bool = row[0]
+                try:
+                    yield acquired
+                finally:
+                    if acquired and not conn.closed:
+                        await cur.execute(
+                            "SELECT pg_advisory_unlock(%(key)s, hashtext(%(subject)s));",
+                            {"key": _LOCK_KEY >> 32, "subject": subject},
+                        )
+
+    async def ensure_table_exists(self) -> None:
+        """
+        Creates the migrations tables if they do not exist. Concurrent
+        `CREATE TABLE IF NOT EXISTS` statements can fail, so hold `lock()`
+        when other instances may be creating them too.
+        """
+        await self._ensure_table_exists()
+
+    async def get_checkpoint(self, subject: str, version: str) -> str | None:
+        await self._ensure_table_exists()
+        async with self._pool.cursor() as cur:
+            await cur.execute(
+                f"""
+SELECT checkpoint
+FROM {_CHECKPOINTS_TABLE_NAME}
+WHERE subject = %(subject)s AND version = %(version)s;
+""",
+                {"subject": subject, "version": version},
+            )
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        checkpoint: str = row[0]
+        return checkpoint
+
+    async def set_checkpoint(self, subject: str, version: str, checkpoint: str) -> None:
+        await self._ensure_table_exists()
+        async with self._pool.cursor() as cur:
+            await cur.execute(
+                f"""
+INSERT INTO {_CHECKPOINTS_TABLE_NAME}
+(subject, version, checkpoint, utc_timestamp)
+VALUES (%(subject)s, %(version)s, %(checkpoint)s, %(utc_timestamp)s)
+ON CONFLICT (subject, version) DO UPDATE
+SET checkpoint = EXCLUDED.checkpoint, utc_timestamp = EXCLUDED.utc_timestamp;
+""",
+                {
+                    "subject": subject,
+                    "version": version,
+                    "checkpoint": checkpoint,
+                    "utc_timestamp": self._clock.utc_now_as_timestamp(),
+                },
+            )
+
+    async def get_latest_versions(self) -> dict[str, str]:
+        await self._ensure_table_exists()
+        async with self._pool.cursor() as cur:
+            await cur.execute(
+                f"""
+SELECT subject, version
+FROM {_STATE_TABLE_NAME};
+"""
+            )
+            latest_versions = {subject: version for subject, version in await cur.fetchall()}
+        self._logger.debug("Got latest versions: %s", latest_versions)
+        return latest_versions
 
     async def get_latest_version(self, subject: str) -> str | None:
         await self._ensure_table_exists()
         async with self._pool.cursor() as cur:
             await cur.execute(
                 f"""
-SELECT subject, version, utc_timestamp
-FROM {_REPOSITORY_TABLE_NAME}
+SELECT subject, version
+FROM {_STATE_TABLE_NAME}
 WHERE subject = %(subject)s;
 """,
                 {"subject": subject},
@@ -40,34 +231,152 @@ WHERE subject = %(subject)s;
             return version
 
     async def set_latest_version(self, subject: str, version: str) -> None:
+        await self.set_latest_versions({subject: version})
+
+    async def set_latest_versions(
+        self,
+        versions: dict[str, str],
+        executions: Sequence[MigrationExecution] = (),
+    ) -> None:
+        if not versions and not executions:
+            return
+
         await self._ensure_table_exists()
-        async with self._pool.cursor() as cur:
-            await cur.execute(
+        statements: list[str] = []
+        params: list[Any] = []
+        if versions:
+            utc_timestamp = self._clock.utc_now_as_timestamp()
+            state_values: list[Any] = []
+            for subject, version in versions.items():
+                params.extend((subject, version, utc_timestamp))
+                state_values.extend((subject, version))
+            statements.append(
                 f"""
 INSERT INTO {_REPOSITORY_TABLE_NAME}
 (subject, version, utc_timestamp)
-VALUES (%(subject)s, %(version)s, %(utc_timestamp)s);
-""",
-                {
-                    "subject": subject,
-                    "version": version,
-                    "utc_timestamp": self._clock.utc_now_as_timestamp(),
-                },
+VALUES {", ".join(["(%s, %s, %s)"] * len(versions))};
+INSERT INTO {_STATE_TABLE_NAME}
+(subject, version)
+VALUES {", ".join(["(%s, %s)"] * len(versions))}
+ON CONFLICT (subject) DO UPDATE SET version = EXCLUDED.version;
+DELETE FROM {_CHECKPOINTS_TABLE_NAME}
+WHERE (subject, version) IN ({", ".join(["(%s, %s)"] * len(versions))});
+"""
             )
+            params.extend(state_values + state_values)
+        if executions:
+            placeholders = f"({', '.join(['%s'] * len(_EXECUTION_COLUMNS))})"
+            statements.append(
+                f"""
+INSERT INTO {_EXECUTIONS_TABLE_NAME}
+({", ".join(_EXECUTION_COLUMNS)})
+VALUES {", ".join([placeholders] * len(executions))};
+"""
+            )
+            for execution in executions:
+                params.extend(getattr(execution, column) for column in _EXECUTION_COLUMNS)
+        async with self._pool.cursor() as cur:
+            # All statements are sent in a single query, so they are
+            # executed in the same implicit transaction.
+            await cur.execute("".join(statements), params)
+
+    async def get_slow_executions(
+        self, min_duration_seconds: float, *, limit: int = 100
+    ) -> list[MigrationExecution]:
+        """
+        Returns the executions that took at least `min_duration_seconds`,
+        slowest first.
+        """
+        await self._ensure_table_exists()
+        return await self._pool.fetch_as(
+            MigrationExecution,
+            f"""
+SELECT {", ".join(_EXECUTION_COLUMNS)}
+FROM {_EXECUTIONS_TABLE_NAME}
+WHERE duration_seconds >= %(min_duration_seconds)s
+ORDER BY duration_seconds DESC
+LIMIT %(limit)s;
+""",
+            {"min_duration_seconds": min_duration_seconds, "limit": limit},
+        )
+
+    async def get_failed_executions(
+        self, *, since: datetime.datetime | None = None, limit: int = 100
+    ) -> list[MigrationExecution]:
+        """
+        Returns the failed executions started after `since`, latest first.
+        """
+        await self._ensure_table_exists()
+        return await self._pool.fetch_as(
+            MigrationExecution,
+            f"""
+SELECT {", ".join(_EXECUTION_COLUMNS)}
+FROM {_EXECUTIONS_TABLE_NAME}
+WHERE NOT succeeded AND started_at >= %(since)s
+ORDER BY started_at DESC
+LIMIT %(limit)s;
+""",
+            {
+                "since": since or datetime.datetime.min.replace(tzinfo=datetime.UTC),
+                "limit": limit,
+            },
+        )
 
     async def _ensure_table_exists(self) -> None:
         if self._has_ensured_table_exists:
             return
 
-        async with self._pool.cursor() as cur:
-            await cur.execute(
-                f"""
+        async with self._ensure_table_exists_lock:
+            if self._has_ensured_table_exists:
+                return
+
+            # The state table is filled from the history only when it is
+            # empty, i.e. the first time it is created. Versions are compared
+            # with the "C" collation to match how PgMigration compares them.
+            async with self._pool.cursor() as cur:
+                await cur.execute(
+                    f"""
 CREATE TABLE IF NOT EXISTS {_REPOSITORY_TABLE_NAME} (
     subject text not null,
     version text not null,
     utc_timestamp text not null,
     CONSTRAINT subject_version PRIMARY KEY(subject, version)
 );
+CREATE TABLE IF NOT EXISTS {_STATE_TABLE_NAME} (
+    subject text not null PRIMARY KEY,
+    version text not null
+);
+CREATE TABLE IF NOT EXISTS {_CHECKPOINTS_TABLE_NAME} (
+    subject text not null,
+    version text not null,
+    checkpoint text not null,
+    utc_timestamp text not null,
+    CONSTRAINT checkpoint_subject_version PRIMARY KEY(subject, version)
+);
+CREATE TABLE IF NOT EXISTS {_EXECUTIONS_TABLE_NAME} (
+    id bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    subject text not null,
+    version text not null,
+    started_at timestamptz not null,
+    duration_seconds double precision not null,
+    lock_wait_seconds double precision not null,
+    succeeded boolean not null,
+    error text,
+    host text not null,
+    app_version text,
+    background boolean not null
+);
+CREATE INDEX IF NOT EXISTS {_EXECUTIONS_TABLE_NAME}_subject_version_idx
+ON {_EXECUTIONS_TABLE_NAME} (subject, version);
+CREATE INDEX IF NOT EXISTS {_EXECUTIONS_TABLE_NAME}_duration_idx
+ON {_EXECUTIONS_TABLE_NAME} (duration_seconds DESC);
+CREATE INDEX IF NOT EXISTS {_EXECUTIONS_TABLE_NAME}_failed_idx
+ON {_EXECUTIONS_TABLE_NAME} (started_at DESC) WHERE NOT succeeded;
+INSERT INTO {_STATE_TABLE_NAME} (subject, version)
+SELECT DISTINCT ON (subject) subject, version
+FROM {_REPOSITORY_TABLE_NAME}
+WHERE NOT EXISTS (SELECT 1 FROM {_STATE_TABLE_NAME})
+ORDER BY subject, version COLLATE "C" DESC;
 """
-            )
-        self._has_ensured_table_exists = True
+                )
+            self._has_ensured_table_exists = True
@@ -42,6 +42,9 @@ setup(
     scripts=[],
     package_data={"applipy_pg": ["py.typed"]},
     extras_require={
+        "numpy": [
+            "numpy>=1.26.0",
+        ],
         "dev": [
             "docker==7.1.0",
             # This is the version required for docker to work: https://github.com/docker/docker-py/issues/3256
@@ -52,6 +55,7 @@ setup(
             "mypy==1.8.0",
             "flake8==6.1.0",
             "testcontainers-postgres==0.0.1rc1",
+            "numpy>=1.26.0",
         ],
     },
 )
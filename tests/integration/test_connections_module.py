@@ -1,13 +1,58 @@
-from typing import Any
-from unittest.mock import Mock
+import asyncio
+import datetime
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, NamedTuple
+from unittest.mock import Mock, patch
 
+import numpy
+import psycopg2
 import pytest
 from applipy import Config
 from applipy_inject.inject import Injector
+from psycopg2 import sql
+from psycopg2.errors import QueryCanceledError, UndefinedTable
+from psycopg2.extensions import parse_dsn
+from psycopg2.extras import Json
 
-from applipy_pg import PgModule
+from applipy_pg import (
+    DeadlineExceededError,
+    HealthPolicy,
+    PgBufferedWriter,
+    PgConnection,
+    PgModule,
+    PgPoolRegistry,
+    PgRecordingPool,
+    PgReplayPool,
+    PgStatementsCollector,
+    UnrecordedQueryError,
+    deadline,
+    scoped_settings,
+)
 from applipy_pg.connections.handle import PgAppHandle
 from applipy_pg.connections.pool_handle import PgPool
+from applipy_pg.connections.types import TypeCache
+
+
+@dataclass
+class _DataclassRow:
+    id: int
+    name: str
+    score: float | None = None
+
+
+class _NamedTupleRow(NamedTuple):
+    id: int
+    name: str
+
+
+class _SlotsRow:
+    __slots__ = ("id", "name")
+
+    id: int
+    name: str
 
 
 @pytest.mark.asyncio
@@ -155,3 +200,1147 @@ class TestPgModule:
         sut.configure(injector.bind, register)
         assert injector.get(PgPool, "db1") is injector.get(PgPool, "db2")
         assert injector.get(PgPool, "db1") is injector.get(PgPool, "db3")
+
+    async def test_configure_connection_parameters(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        database_anon.update({
+            "connect_timeout": 5,
+            "keepalives": True,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 3,
+            "tcp_user_timeout": 10000,
+        })
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT 1")
+            result = await cur.fetchone()
+            dsn_params = parse_dsn(cur.connection.dsn)
+        assert result == (1,)
+
+        assert dsn_params["connect_timeout"] == "5"
+        assert dsn_params["keepalives"] == "1"
+        assert dsn_params["keepalives_idle"] == "30"
+        assert dsn_params["keepalives_interval"] == "10"
+        assert dsn_params["keepalives_count"] == "3"
+        assert dsn_params["tcp_user_timeout"] == "10000"
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_cursor_settings_are_transaction_local(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 1}
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        async with pool.cursor(settings={"statement_timeout": "1234"}) as cur:
+            await cur.execute("SHOW statement_timeout")
+            assert await cur.fetchone() == ("1234ms",)
+            await cur.execute("CREATE TABLE test_settings (id int)")
+
+        with pytest.raises(RuntimeError):
+            async with pool.cursor(settings={"statement_timeout": "1234"}) as cur:
+                await cur.execute("INSERT INTO test_settings VALUES (1)")
+                raise RuntimeError()
+
+        async with pool.cursor() as cur:
+            await cur.execute("SHOW statement_timeout")
+            assert await cur.fetchone() == ("0",)
+            await cur.execute("SELECT count(*) FROM test_settings")
+            assert await cur.fetchone() == (0,)
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_scoped_settings_are_reset_on_release(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 1}
+        database_anon["session"] = {"statement_timeout": "5s"}
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        with scoped_settings({"lock_timeout": "100ms", "statement_timeout": "1s"}):
+            with scoped_settings({"lock_timeout": "200ms"}):
+                async with pool.cursor(settings={"work_mem": "8MB"}) as cur:
+                    await cur.execute(
+                        "SELECT current_setting('lock_timeout'), current_setting('statement_timeout'),"
+                        " current_setting('work_mem')"
+                    )
+                    assert await cur.fetchone() == ("200ms", "1s", "8MB")
+            async with pool.cursor() as cur:
+                await cur.execute("SHOW lock_timeout")
+                assert await cur.fetchone() == ("100ms",)
+
+        async with pool.cursor() as cur:
+            await cur.execute(
+                "SELECT current_setting('lock_timeout'), current_setting('statement_timeout')"
+            )
+            assert await cur.fetchone() == ("0", "5s")
+
+        with pytest.raises(ValueError):
+            with scoped_settings({"lock_timeout; DROP TABLE x": "1s"}):
+                pass
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_types_are_resolved_once(self, database_anon: dict[str, Any]) -> None:
+        setup_pool = PgPool(PgConnection(**database_anon))
+        async with setup_pool.cursor() as cur:
+            await cur.execute(
+                "CREATE TYPE test_point AS (x int, label text);"
+                "CREATE SCHEMA test_schema;"
+                "CREATE TYPE test_schema.test_mood AS ENUM ('happy', 'sad');"
+            )
+        (await setup_pool.pool()).close()
+        database_anon["config"] = {"minsize": 3, "maxsize": 3}
+        database_anon["types"] = ["test_point", "test_schema.test_mood"]
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        with patch.object(TypeCache, "_resolve", autospec=True, side_effect=TypeCache._resolve) as resolve:
+            async with pool.cursor() as cur:
+                await cur.execute(
+                    "SELECT ROW(1, 'a')::test_point, ARRAY['happy', 'sad']::test_schema.test_mood[]"
+                )
+                point, moods = await cur.fetchone()
+            assert (point.x, point.label) == (1, "a")
+            assert moods == ["happy", "sad"]
+            assert resolve.call_count == 1
+
+            async with pool.cursor() as cur:
+                await cur.execute("ALTER TYPE test_point ADD ATTRIBUTE z int")
+            await pool.refresh_types()
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT ROW(1, 'a', 2)::test_point")
+                (point,) = await cur.fetchone()
+            assert point.z == 2
+            assert resolve.call_count == 2
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_missing_types_are_resolved_again(self, database_anon: dict[str, Any]) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 2}
+        database_anon["types"] = ["test_late_point"]
+        pool = PgPool(PgConnection(**database_anon))
+
+        async with pool.cursor() as cur:
+            await cur.execute("CREATE TYPE test_late_point AS (x int, label text);")
+            async with pool.cursor() as new_cur:
+                await new_cur.execute("SELECT ROW(1, 'a')::test_late_point")
+                (point,) = await new_cur.fetchone()
+
+        assert (point.x, point.label) == (1, "a")
+        await pool.close()
+
+    async def test_pool_per_event_loop(self, database_anon: dict[str, Any]) -> None:
+        database_anon["config"] = {"minsize": 2, "maxsize": 4}
+        database_anon["event_loops"] = 2
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+        other_loop = asyncio.new_event_loop()
+        other_thread = threading.Thread(target=other_loop.run_forever)
+        other_thread.start()
+
+        async def query() -> tuple[Any, Any]:
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT 1")
+                return await cur.fetchone(), await pool.pool()
+
+        try:
+            result, aiopg_pool = await query()
+            other_result, other_aiopg_pool = await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(query(), other_loop)
+            )
+            assert result == other_result == (1,)
+            assert aiopg_pool is not other_aiopg_pool
+            assert aiopg_pool is await pool.pool()
+            assert aiopg_pool.maxsize == other_aiopg_pool.maxsize == 2
+
+            injector.bind(PgAppHandle)
+            await injector.get(PgAppHandle).on_shutdown()
+            assert aiopg_pool.closed
+            assert other_aiopg_pool.closed
+        finally:
+            other_loop.call_soon_threadsafe(other_loop.stop)
+            other_thread.join()
+            other_loop.close()
+
+    async def test_deadline(self, database_anon: dict[str, Any]) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 1}
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        with deadline(10):
+            with deadline(20):
+                async with pool.cursor() as cur:
+                    await cur.execute("SELECT current_setting('statement_timeout')::interval")
+                    (statement_timeout,) = await cur.fetchone()
+                    assert 9 < statement_timeout.total_seconds() <= 10
+
+        with deadline(0.2):
+            with pytest.raises(DeadlineExceededError):
+                async with pool.cursor(timeout=10) as cur:
+                    await cur.execute("SELECT pg_sleep(1)")
+
+        with pytest.raises(QueryCanceledError):
+            async with pool.cursor(settings={"statement_timeout": "100ms"}) as cur:
+                await cur.execute("SELECT pg_sleep(1)")
+
+        async with pool.cursor() as cur:
+            with deadline(0.2):
+                with pytest.raises(DeadlineExceededError):
+                    async with pool.cursor():
+                        pass
+            await cur.execute("SHOW statement_timeout")
+            assert await cur.fetchone() == ("0",)
+
+        with deadline(0):
+            with pytest.raises(DeadlineExceededError):
+                pool.cursor()
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_pool_timeout_is_not_a_deadline(self, database_anon: dict[str, Any]) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 1, "timeout": 0.2}
+        pool = PgPool(PgConnection(**database_anon))
+
+        async with pool.cursor():
+            # aiopg's own timeout waiting for the only connection
+            with pytest.raises(TimeoutError) as exc_info:
+                async with pool.cursor():
+                    pass
+            assert not isinstance(exc_info.value, DeadlineExceededError)
+
+            with deadline(10):
+                with pytest.raises(TimeoutError) as exc_info:
+                    async with pool.cursor():
+                        pass
+                assert not isinstance(exc_info.value, DeadlineExceededError)
+
+        await pool.close()
+
+    async def test_cancelled_statement_is_terminated(self, database_anon: dict[str, Any]) -> None:
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        async def sleep() -> None:
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT pg_sleep(30) AS test_cancelled_statement")
+
+        task = asyncio.create_task(sleep())
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        async with pool.cursor() as cur:
+            await cur.execute(
+                "SELECT count(*) FROM pg_stat_activity"
+                " WHERE query LIKE '%%AS test_cancelled_statement' AND pid <> pg_backend_pid()"
+            )
+            assert await cur.fetchone() == (0,)
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_cancelled_statements_are_terminated_together(self, database_anon: dict[str, Any]) -> None:
+        pool = PgPool(PgConnection(**database_anon))
+
+        async def sleep() -> None:
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT pg_sleep(30) AS test_cancelled_statements")
+
+        tasks = [asyncio.create_task(sleep()) for _ in range(5)]
+        await asyncio.sleep(0.5)
+        with patch.object(pool, "connect", wraps=pool.connect) as connect:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # One connection for the first backend and one for the rest
+        assert connect.call_count <= 2
+
+        async with pool.cursor() as cur:
+            await cur.execute(
+                "SELECT count(*) FROM pg_stat_activity"
+                " WHERE query LIKE '%%AS test_cancelled_statements' AND pid <> pg_backend_pid()"
+            )
+            assert await cur.fetchone() == (0,)
+        await pool.close()
+
+    async def test_cancelled_statement_is_not_terminated_through_transaction_pooler(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        pool = PgPool(PgConnection(**database_anon, pooler="pgbouncer-transaction"))
+
+        async def sleep() -> None:
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT pg_sleep(2) AS test_pooled_statement")
+
+        task = asyncio.create_task(sleep())
+        await asyncio.sleep(0.5)
+        with patch.object(pool, "connect", wraps=pool.connect) as connect:
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        assert connect.call_count == 0
+
+        await pool.close()
+
+    async def test_reconfigure_pools(
+        self, database_anon: dict[str, Any], database_test1: dict[str, Any]
+    ) -> None:
+        database_test1["aliases"] = ["alias1"]
+        config = Config(
+            {
+                "pg.connections": [database_test1],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool, "test1")
+        registry = injector.get(PgPoolRegistry)
+        assert registry.get("test1") is registry.get("alias1") is pool
+
+        async with pool.cursor() as old_cur:
+            await old_cur.execute("SELECT current_database()")
+            assert await old_cur.fetchone() == (database_test1["dbname"],)
+            old_aiopg_pool = await pool.pool()
+
+            await registry.apply_config(
+                Config(
+                    {
+                        "pg.global_config": {"maxsize": 3},
+                        "pg.connections": [{**database_anon, "name": "test1", "aliases": ["alias1"]}],
+                    }
+                )
+            )
+
+            async with injector.get(PgPool, "alias1").cursor() as cur:
+                await cur.execute("SELECT current_database()")
+                assert await cur.fetchone() == (database_anon["dbname"],)
+            new_aiopg_pool = await pool.pool()
+            assert new_aiopg_pool is not old_aiopg_pool
+            assert new_aiopg_pool.maxsize == 3
+
+            # The acquired connection keeps working while the old pool drains
+            await old_cur.execute("SELECT 1")
+            assert not old_aiopg_pool.closed
+        await asyncio.sleep(0.1)
+        assert old_aiopg_pool.closed
+
+        with pytest.raises(ValueError):
+            await registry.apply_config(Config({"pg.connections": [database_anon]}))
+        with pytest.raises(ValueError):
+            await registry.apply_config(
+                Config({"pg.connections": [{**database_anon, "name": "test1", "aliases": ["alias2"]}]})
+            )
+
+        await pool.close()
+        assert new_aiopg_pool.closed
+
+    async def test_transaction_pooler_refuses_named_cursors(self) -> None:
+        config = Config(
+            {
+                "pg.connections": [{
+                    "user": "some_user",
+                    "host": "192.168.5.1",
+                    "dbname": "test1231241",
+                    "pooler": "pgbouncer-transaction",
+                }],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        with pytest.raises(ValueError):
+            pool.cursor("named_cursor")
+        with pytest.raises(ValueError):
+            pool.cursor(withhold=True)
+
+    async def test_session_settings_applied_on_connect(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        database_anon["session"] = {
+            "statement_timeout": "5s",
+            "search_path": "public, pg_catalog",
+        }
+        config = Config(
+            {
+                "pg.global_session": {
+                    "statement_timeout": "1s",
+                    "application_name": "test app",
+                    "jit": False,
+                },
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        async with pool.cursor() as cur:
+            await cur.execute(
+                "SELECT current_setting('statement_timeout'), current_setting('search_path'),"
+                " current_setting('application_name'), current_setting('jit')"
+            )
+            assert await cur.fetchone() == ("5s", "public, pg_catalog", "test app", "off")
+            await cur.execute("RESET ALL")
+            await cur.execute(
+                "SELECT current_setting('statement_timeout'), current_setting('search_path'),"
+                " current_setting('application_name'), current_setting('jit')"
+            )
+            assert await cur.fetchone() == ("5s", "public, pg_catalog", "test app", "off")
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_session_settings_with_transaction_pooler(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        database_anon["session"] = {"statement_timeout": "5s", "work_mem": "8MB"}
+        database_anon["pooler"] = "pgbouncer-transaction"
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        async with pool.cursor(settings={"work_mem": "16MB"}) as cur:
+            await cur.execute(
+                "SELECT current_setting('statement_timeout'), current_setting('work_mem')"
+            )
+            assert await cur.fetchone() == ("5s", "16MB")
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_fetch_as(self, database_anon: dict[str, Any]) -> None:
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+        sql = "SELECT name, id FROM (VALUES (1, 'a'), (2, 'b')) AS t (id, name) ORDER BY id"
+
+        dataclass_rows = await pool.fetch_as(_DataclassRow, sql)
+        assert dataclass_rows == [_DataclassRow(1, "a"), _DataclassRow(2, "b")]
+
+        namedtuple_rows = await pool.fetch_as(_NamedTupleRow, sql)
+        assert namedtuple_rows == [_NamedTupleRow(1, "a"), _NamedTupleRow(2, "b")]
+
+        slots_rows = await pool.fetch_as(_SlotsRow, sql)
+        assert [(row.id, row.name) for row in slots_rows] == [(1, "a"), (2, "b")]
+
+        with pytest.raises(ValueError):
+            await pool.fetch_as(_NamedTupleRow, "SELECT 1 AS id, 'a' AS name, 2 AS other")
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_fetch_columns(self, database_anon: dict[str, Any]) -> None:
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+
+        columns = await pool.fetch_columns(
+            """
+SELECT g AS id,
+       CASE WHEN g % 2 = 0 THEN NULL ELSE g * 0.5::float8 END AS value,
+       g::numeric AS amount
+FROM generate_series(1, 3000) g ORDER BY g
+""",
+            dtypes={"amount": "float64"},
+        )
+        assert list(columns) == ["id", "value", "amount"]
+        assert columns["id"].dtype == numpy.int32
+        assert columns["id"].tolist() == list(range(1, 3001))
+        assert columns["value"].dtype == numpy.float64
+        assert columns["value"].tolist()[:4] == [0.5, None, 1.5, None]
+        assert columns["value"].count() == 1500
+        assert columns["amount"].dtype == numpy.float64
+        assert columns["amount"].sum() == sum(range(1, 3001))
+
+        dates = await pool.fetch_columns(
+            "SELECT d::date AS day, d::timestamp AS ts FROM (VALUES ('2024-01-01'), (NULL)) AS t (d)"
+        )
+        assert dates["day"].dtype == numpy.dtype("datetime64[D]")
+        assert dates["day"].tolist() == [datetime.date(2024, 1, 1), None]
+        assert dates["ts"].dtype == numpy.dtype("datetime64[us]")
+        assert dates["ts"].tolist() == [datetime.datetime(2024, 1, 1), None]
+        assert numpy.isnat(dates["day"].data[1]) and numpy.isnat(dates["ts"].data[1])
+
+        empty = await pool.fetch_columns("SELECT 1 AS id WHERE false")
+        assert len(empty["id"]) == 0
+
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+
+@pytest.mark.asyncio
+class TestPgBufferedWriter:
+    async def test_rows_are_flushed_by_size_interval_and_shutdown(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        database_anon["writer"] = {"flush_rows": 10, "flush_interval": 0.2, "max_rows": 100}
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+        writer = injector.get(PgBufferedWriter)
+        async with pool.cursor() as cur:
+            await cur.execute("CREATE TABLE test_writer (id int, name text)")
+
+        async def count() -> int:
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT count(*) FROM test_writer")
+                result: int = (await cur.fetchone())[0]
+                return result
+
+        for i in range(3):
+            assert writer.write_nowait("public.test_writer", ("id", "name"), (i, f"name {i}"))
+        await asyncio.sleep(0.05)
+        assert await count() == 0
+        await asyncio.sleep(0.3)
+        assert await count() == 3
+
+        for i in range(3, 25):
+            assert writer.write_nowait("public.test_writer", ("id", "name"), (i, f"name {i}"))
+        await asyncio.sleep(0.05)
+        assert await count() == 25
+
+        writer.write_nowait("test_writer", ("id",), (25,))
+        injector.bind(PgAppHandle)
+        await injector.get(PgAppHandle).on_shutdown()
+        del database_anon["writer"]
+        pool = PgPool(PgConnection(**database_anon))
+        assert await count() == 26
+        with pytest.raises(RuntimeError):
+            writer.write_nowait("test_writer", ("id",), (26,))
+        (await pool.pool()).close()
+
+    @pytest.mark.parametrize("overflow, expected_ids", [
+        ("drop-newest", [0, 1, 2]),
+        ("drop-oldest", [2, 3, 4]),
+    ])
+    async def test_overflow(
+        self, database_anon: dict[str, Any], overflow: str, expected_ids: list[int]
+    ) -> None:
+        pool = PgPool(PgConnection(**database_anon))
+        async with pool.cursor() as cur:
+            await cur.execute("CREATE TABLE test_writer (id int)")
+        writer = PgBufferedWriter(pool, flush_rows=3, flush_interval=10, max_rows=3, overflow=overflow)
+
+        results = [writer.write_nowait("test_writer", ("id",), (i,)) for i in range(5)]
+        await writer.close()
+
+        assert results == [True, True, True, overflow == "drop-oldest", overflow == "drop-oldest"]
+        assert writer.dropped_rows == 2
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT id FROM test_writer ORDER BY id")
+            assert [row[0] for row in await cur.fetchall()] == expected_ids
+        (await pool.pool()).close()
+
+    async def test_write_waits_for_room(self, database_anon: dict[str, Any]) -> None:
+        pool = PgPool(PgConnection(**database_anon))
+        async with pool.cursor() as cur:
+            await cur.execute("CREATE TABLE test_writer (id int)")
+        writer = PgBufferedWriter(pool, flush_rows=2, flush_interval=10, max_rows=2)
+
+        for i in range(10):
+            await writer.write("test_writer", ("id",), (i,))
+        await writer.close()
+
+        assert writer.dropped_rows == 0
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT count(*) FROM test_writer")
+            assert await cur.fetchone() == (10,)
+        (await pool.pool()).close()
+
+    async def test_flushes_do_not_inherit_the_first_write_context(self, database_anon: dict[str, Any]) -> None:
+        pool = PgPool(PgConnection(**database_anon))
+        async with pool.cursor() as cur:
+            await cur.execute("CREATE TABLE test_writer (id int)")
+        writer = PgBufferedWriter(pool, flush_rows=10, flush_interval=0.1)
+
+        with deadline(0.01):
+            writer.write_nowait("test_writer", ("id",), (1,))
+        await asyncio.sleep(0.05)
+        writer.write_nowait("test_writer", ("id",), (2,))
+        await asyncio.sleep(0.3)
+
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT id FROM test_writer ORDER BY id")
+            assert await cur.fetchall() == [(1,), (2,)]
+        await writer.close()
+        await pool.close()
+
+    async def test_rows_failing_transiently_are_kept(self, database_anon: dict[str, Any]) -> None:
+        connection = PgConnection(**database_anon)
+        # Nothing listens on this port, so connecting fails
+        pool = PgPool(PgConnection(**{**database_anon, "port": 1}))
+        writer = PgBufferedWriter(pool, flush_rows=10, flush_interval=10)
+
+        writer.write_nowait("test_writer", ("id",), (1,))
+        with pytest.raises(psycopg2.OperationalError):
+            await writer.flush()
+        await pool.reconfigure(connection)
+        async with pool.cursor() as cur:
+            await cur.execute("CREATE TABLE test_writer (id int)")
+        await writer.close()
+
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT id FROM test_writer")
+            assert await cur.fetchall() == [(1,)]
+        await pool.close()
+
+    async def test_rejected_rows_are_dropped(self, database_anon: dict[str, Any]) -> None:
+        database_anon["writer"] = {"flush_rows": 10, "flush_interval": 0.1}
+        sut = PgModule(Config({"pg.connections": [database_anon]}))
+        injector = Injector()
+        sut.configure(injector.bind, Mock())
+        injector.bind(PgAppHandle)
+        pool = injector.get(PgPool)
+        writer = injector.get(PgBufferedWriter)
+        async with pool.cursor() as cur:
+            await cur.execute("CREATE TABLE test_writer (id int NOT NULL)")
+
+        for row_id in (1, 2, None, 3, 4, 5):
+            writer.write_nowait("test_writer", ("id",), (row_id,))
+        await asyncio.sleep(0.3)
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT id FROM test_writer ORDER BY id")
+            assert await cur.fetchall() == [(1,), (2,), (3,), (4,), (5,)]
+        assert writer.rejected_rows == 1
+
+        # Rows rejected on shutdown do not prevent closing the pools
+        writer.write_nowait("test_writer_missing", ("id",), (1,))
+        aiopg_pool = await pool.pool()
+        await injector.get(PgAppHandle).on_shutdown()
+        assert writer.rejected_rows == 2
+        assert aiopg_pool.closed
+
+    async def test_invalid_params(self) -> None:
+        pool = PgPool(PgConnection(user="user", dbname="db"))
+        with pytest.raises(ValueError):
+            PgBufferedWriter(pool, flush_rows=0)
+        with pytest.raises(ValueError):
+            PgBufferedWriter(pool, flush_rows=10, max_rows=5)
+        with pytest.raises(ValueError):
+            PgBufferedWriter(pool, overflow="block")
+
+
+# Stands in for the pg_stat_statements view, which requires the extension to
+# be preloaded by the server.
+_CREATE_FAKE_STATEMENTS = """
+CREATE TABLE pg_stat_statements (
+    userid oid, dbid oid, toplevel bool, queryid bigint, query text, calls bigint,
+    total_exec_time float8, rows bigint,
+    shared_blks_read bigint, shared_blks_written bigint, local_blks_read bigint,
+    local_blks_written bigint, temp_blks_read bigint, temp_blks_written bigint
+);
+"""
+_INSERT_FAKE_STATEMENT = """
+INSERT INTO pg_stat_statements VALUES (
+    (SELECT oid FROM pg_roles WHERE rolname = current_user),
+    (SELECT oid FROM pg_database WHERE datname = current_database()),
+    %s, %s, %s, %s, %s, %s, %s, 0, 0, 0, 0, 0
+);
+"""
+
+
+@pytest.mark.asyncio
+class TestPgStatementsCollector:
+    async def test_collects_deltas_between_snapshots(self, database_anon: dict[str, Any]) -> None:
+        database_anon["statements"] = {"top_n": 2, "history": 2}
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        pool = injector.get(PgPool)
+        collector = injector.get(PgStatementsCollector)
+        async with pool.cursor() as cur:
+            await cur.execute(_CREATE_FAKE_STATEMENTS)
+            await cur.execute(_INSERT_FAKE_STATEMENT, (True, 1, "SELECT 1", 10, 100.0, 10, 5))
+            await cur.execute(_INSERT_FAKE_STATEMENT, (False, 1, "SELECT 1", 1, 10.0, 1, 0))
+            await cur.execute(_INSERT_FAKE_STATEMENT, (True, 2, "SELECT 2", 1, 1000.0, 1, 50))
+            # Statements of other roles are not collected
+            await cur.execute(
+                "INSERT INTO pg_stat_statements VALUES (0, 0, true, 3, 'SELECT 3', 1, 1, 1, 1, 0, 0, 0, 0, 0)"
+            )
+
+        assert await collector.collect() == []
+
+        async with pool.cursor() as cur:
+            await cur.execute(
+                "UPDATE pg_stat_statements SET calls = calls + 5, total_exec_time = total_exec_time + 50"
+                " WHERE queryid = 1 AND toplevel"
+            )
+            await cur.execute(_INSERT_FAKE_STATEMENT, (True, 4, "SELECT 4", 2, 20.0, 2, 100))
+        deltas = await collector.collect()
+        assert sorted((stats.queryid, stats.calls, stats.total_time) for stats in deltas) == [
+            (1, 5, 50.0),
+            (4, 2, 20.0),
+        ]
+
+        async with pool.cursor() as cur:
+            await cur.execute(
+                "UPDATE pg_stat_statements SET calls = calls + 1, total_exec_time = total_exec_time + 20"
+                " WHERE queryid = 4"
+            )
+        await collector.collect()
+        assert [(stats.queryid, stats.calls) for stats in collector.top()] == [(1, 5), (4, 3)]
+        assert [stats.queryid for stats in collector.top(1, by="calls")] == [1]
+        assert [stats.queryid for stats in collector.top(by="io_blocks", intervals=1)] == [4]
+
+        await collector.close()
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_statements_cut_off_from_the_snapshot_are_skipped(
+        self, database_anon: dict[str, Any]
+    ) -> None:
+        pool = PgPool(PgConnection(**database_anon))
+        collector = PgStatementsCollector(pool, top_n=1, max_statements=1)
+        async with pool.cursor() as cur:
+            await cur.execute(_CREATE_FAKE_STATEMENTS)
+            await cur.execute(_INSERT_FAKE_STATEMENT, (True, 1, "SELECT 1", 1, 100.0, 1, 0))
+            await cur.execute(_INSERT_FAKE_STATEMENT, (True, 2, "SELECT 2", 1, 10.0, 1, 0))
+        await collector.collect()
+
+        async with pool.cursor() as cur:
+            await cur.execute("UPDATE pg_stat_statements SET total_exec_time = 1000, calls = 2 WHERE queryid = 2")
+        assert await collector.collect() == []
+
+        await collector.close()
+        aiopg_pool = await pool.pool()
+        aiopg_pool.close()
+        await aiopg_pool.wait_closed()
+
+    async def test_stops_without_pg_stat_statements(self, database_anon: dict[str, Any]) -> None:
+        database_anon["statements"] = {"interval": 0.1}
+        config = Config(
+            {
+                "pg.connections": [database_anon],
+            }
+        )
+        sut = PgModule(config)
+        injector = Injector()
+        register = Mock()
+        sut.configure(injector.bind, register)
+        injector.bind(PgAppHandle)
+        app_handle = injector.get(PgAppHandle)
+        collector = injector.get(PgStatementsCollector)
+
+        await app_handle.on_start()
+        assert collector._task is not None
+        await asyncio.wait_for(collector._task, 5)
+        assert collector._conn is None
+
+        await app_handle.on_shutdown()
+
+    async def test_invalid_params(self) -> None:
+        pool = PgPool(PgConnection(user="user", dbname="db"))
+        with pytest.raises(ValueError):
+            PgStatementsCollector(pool, interval=0)
+        with pytest.raises(ValueError):
+            PgStatementsCollector(pool, top_n=10, max_statements=5)
+        with pytest.raises(ValueError):
+            PgStatementsCollector(pool).top(by="rows")
+
+
+async def _run_data_access(pool: PgPool) -> list[Any]:
+    results: list[Any] = []
+    async with pool.cursor() as cur:
+        await cur.execute("CREATE TABLE IF NOT EXISTS test_replay (id int, name text)")
+        await cur.execute(
+            sql.SQL("INSERT INTO {} VALUES (%s, %s), (%s, %s)").format(sql.Identifier("test_replay")),
+            (1, "a", 2, "b"),
+        )
+        results.append(cur.rowcount)
+        await cur.execute("SELECT id, name FROM test_replay WHERE id > %s ORDER BY id", (0,))
+        results.append(await cur.fetchone())
+        results.append(await cur.fetchall())
+    results.append(await pool.fetch_as(_NamedTupleRow, "SELECT id, name FROM test_replay ORDER BY id"))
+    async with pool.cursor() as cur:
+        with pytest.raises(UndefinedTable):
+            await cur.execute("SELECT * FROM test_replay_missing")
+    return results
+
+
+@pytest.mark.asyncio
+class TestPgReplayPool:
+    async def test_record_and_replay(self, database_anon: dict[str, Any], tmp_path: Path) -> None:
+        path = str(tmp_path / "recording.pickle")
+        database_anon["record"] = {"path": path}
+        sut = PgModule(Config({"pg.connections": [database_anon]}))
+        injector = Injector()
+        sut.configure(injector.bind, Mock())
+        injector.bind(PgAppHandle)
+        pool = injector.get(PgPool)
+        assert isinstance(pool, PgRecordingPool)
+        recorded = await _run_data_access(pool)
+        await injector.get(PgAppHandle).on_shutdown()
+
+        del database_anon["record"]
+        # Replaying never connects to the database
+        database_anon["host"] = "unreachable.invalid"
+        database_anon["replay"] = {"path": path}
+        sut = PgModule(Config({"pg.connections": [database_anon]}))
+        injector = Injector()
+        sut.configure(injector.bind, Mock())
+        pool = injector.get(PgPool)
+        assert isinstance(pool, PgReplayPool)
+        replayed = await _run_data_access(pool)
+        assert replayed == recorded == [
+            2,
+            (1, "a"),
+            [(2, "b")],
+            [_NamedTupleRow(1, "a"), _NamedTupleRow(2, "b")],
+        ]
+
+        async with pool.cursor() as cur:
+            with pytest.raises(UnrecordedQueryError):
+                await cur.execute("SELECT id, name FROM test_replay WHERE id > %s ORDER BY id", (1,))
+        with pytest.raises(RuntimeError):
+            await pool.pool()
+
+    async def test_replay_adapted_parameters(self, database_anon: dict[str, Any], tmp_path: Path) -> None:
+        path = str(tmp_path / "recording.pickle")
+        query = sql.SQL("SELECT %s::jsonb -> 'ids', {}::jsonb").format(sql.Literal(Json([3])))
+        recording_pool = PgRecordingPool(PgConnection(**database_anon), path=path)
+        async with recording_pool.cursor() as cur:
+            await cur.execute(query, (Json({"ids": [1, 2]}),))
+            recorded = await cur.fetchone()
+        await recording_pool.close()
+
+        pool = PgReplayPool(PgConnection(**database_anon), path=path)
+        async with pool.cursor() as cur:
+            await cur.execute(query, (Json({"ids": [1, 2]}),))
+            assert await cur.fetchone() == recorded == ([1, 2], [3])
+            with pytest.raises(UnrecordedQueryError):
+                await cur.execute(query, (Json({"ids": [1]}),))
+
+    async def test_replay_latency(self, database_anon: dict[str, Any], tmp_path: Path) -> None:
+        path = str(tmp_path / "recording.pickle")
+        recording_pool = PgRecordingPool(PgConnection(**database_anon), path=path)
+        async with recording_pool.cursor() as cur:
+            await cur.execute("SELECT 1")
+        await recording_pool.close()
+
+        pool = PgReplayPool(
+            PgConnection(**database_anon, config={"maxsize": 2}), path=path, latency=0.05, jitter=0.01, seed=1
+        )
+
+        async def select_one() -> Any:
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT 1")
+                return await cur.fetchone()
+
+        start = time.monotonic()
+        assert await asyncio.gather(*(select_one() for _ in range(4))) == [(1,)] * 4
+        # Only two cursors run at a time
+        assert time.monotonic() - start >= 0.1
+
+        with pytest.raises(DeadlineExceededError):
+            with deadline(0.02):
+                await select_one()
+
+    async def test_invalid_params(self, tmp_path: Path) -> None:
+        connection = PgConnection(user="user", dbname="db")
+        with pytest.raises(ValueError):
+            PgRecordingPool(connection, path="")
+        with pytest.raises(ValueError):
+            PgReplayPool(connection, path=str(tmp_path / "recording.pickle"), latency=-1)
+        with pytest.raises(FileNotFoundError):
+            PgReplayPool(connection, path=str(tmp_path / "recording.pickle"))
+
+
+class _NetworkProxy:
+    """Forwards TCP connections to the database, until told to drop them."""
+
+    def __init__(self, host: str, port: int) -> None:
+        self._host = host
+        self._port = port
+        self._server: asyncio.Server | None = None
+        self._dropped: set[asyncio.StreamWriter] = set()
+        self._writers: list[asyncio.StreamWriter] = []
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._forward, "127.0.0.1", 0)
+        return int(self._server.sockets[0].getsockname()[1])
+
+    def drop_connections(self) -> None:
+        # Data is discarded without closing the sockets, so neither end notices
+        self._dropped.update(self._writers)
+
+    async def close(self) -> None:
+        assert self._server is not None
+        self._server.close()
+        for writer in self._writers:
+            writer.close()
+        await self._server.wait_closed()
+
+    async def _forward(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter) -> None:
+        if self._host.startswith("/"):
+            upstream_reader, upstream_writer = await asyncio.open_unix_connection(
+                f"{self._host}/.s.PGSQL.{self._port}"
+            )
+        else:
+            upstream_reader, upstream_writer = await asyncio.open_connection(self._host, self._port)
+        self._writers.extend((client_writer, upstream_writer))
+        await asyncio.gather(
+            self._pipe(client_reader, upstream_writer),
+            self._pipe(upstream_reader, client_writer),
+            return_exceptions=True,
+        )
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while data := await reader.read(65536):
+            if writer not in self._dropped:
+                writer.write(data)
+                await writer.drain()
+        writer.close()
+
+
+async def _get_backend_pid(pool: PgPool) -> int:
+    async with pool.cursor() as cur:
+        await cur.execute("SELECT pg_backend_pid()")
+        row = await cur.fetchone()
+    return int(row[0])
+
+
+@pytest.mark.asyncio
+class TestHealthPolicy:
+    async def test_idle_connections_are_validated(self, database_anon: dict[str, Any]) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 1}
+        database_anon["health"] = {"validate_idle_after": 0.1}
+        sut = PgModule(Config({"pg.connections": [database_anon]}))
+        injector = Injector()
+        sut.configure(injector.bind, Mock())
+        pool = injector.get(PgPool)
+
+        backend_pid = await _get_backend_pid(pool)
+        assert await _get_backend_pid(pool) == backend_pid
+        assert pool.health_stats.validations == 0
+        await asyncio.sleep(0.15)
+
+        assert await _get_backend_pid(pool) == backend_pid
+        assert pool.health_stats.validations == 1
+        assert pool.health_stats.validation_failures == 0
+
+        await pool.close()
+
+    async def test_unresponsive_connections_are_replaced(self, database_anon: dict[str, Any]) -> None:
+        proxy = _NetworkProxy(database_anon["host"], database_anon["port"])
+        database_anon["host"], database_anon["port"] = "127.0.0.1", await proxy.start()
+        database_anon["config"] = {"minsize": 1, "maxsize": 1}
+        database_anon["health"] = {"validate_idle_after": 0.1, "validation_timeout": 0.2}
+        sut = PgModule(Config({"pg.connections": [database_anon]}))
+        injector = Injector()
+        sut.configure(injector.bind, Mock())
+        pool = injector.get(PgPool)
+
+        backend_pid = await _get_backend_pid(pool)
+        # The connection silently stops working, like after a network blip
+        proxy.drop_connections()
+        await asyncio.sleep(0.15)
+
+        assert await _get_backend_pid(pool) != backend_pid
+        assert pool.health_stats.validations == 1
+        assert pool.health_stats.validation_failures == 1
+
+        await pool.close()
+        await proxy.close()
+
+    async def test_connections_are_recycled(self, database_anon: dict[str, Any]) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 1}
+        database_anon["health"] = {"max_lifetime": 0.2, "max_lifetime_jitter": 0.5}
+        sut = PgModule(Config({"pg.connections": [database_anon]}))
+        injector = Injector()
+        sut.configure(injector.bind, Mock())
+        pool = injector.get(PgPool)
+
+        backend_pid = await _get_backend_pid(pool)
+        assert await _get_backend_pid(pool) == backend_pid
+        await asyncio.sleep(0.25)
+
+        assert await _get_backend_pid(pool) != backend_pid
+        assert pool.health_stats.recycles == 1
+
+        await pool.close()
+
+    async def test_idle_connections_are_reaped(self, database_anon: dict[str, Any]) -> None:
+        database_anon["config"] = {"minsize": 1, "maxsize": 3}
+        database_anon["health"] = {"reap_idle_after": 0.2}
+        sut = PgModule(Config({"pg.connections": [database_anon]}))
+        injector = Injector()
+        sut.configure(injector.bind, Mock())
+        pool = injector.get(PgPool)
+
+        async def sleep_in_database() -> None:
+            async with pool.cursor() as cur:
+                await cur.execute("SELECT pg_sleep(0.05)")
+
+        await asyncio.gather(*(sleep_in_database() for _ in range(3)))
+        aiopg_pool = await pool.pool()
+        assert aiopg_pool.size == 3
+
+        await asyncio.sleep(0.5)
+        assert aiopg_pool.size == 1
+        assert pool.health_stats.reaped == 2
+
+        await pool.close()
+
+    async def test_invalid_params(self) -> None:
+        with pytest.raises(ValueError):
+            HealthPolicy(validate_idle_after=0)
+        with pytest.raises(ValueError):
+            HealthPolicy(max_lifetime_jitter=1)
+        with pytest.raises(TypeError):
+            PgConnection(user="user", dbname="db", health={"max_lifetime": 60})  # type: ignore[arg-type]
+
+
+class TestPgConnection:
+    def test_dsn_is_quoted_and_escaped(self) -> None:
+        connection = PgConnection(
+            user="some user",
+            host="/var/run/postgresql",
+            dbname="db",
+            password="it's a \\secret",
+            port=5432,
+            sslmode="require",
+        )
+        assert parse_dsn(connection.get_dsn()) == {
+            "user": "some user",
+            "host": "/var/run/postgresql",
+            "dbname": "db",
+            "password": "it's a \\secret",
+            "port": "5432",
+            "sslmode": "require",
+        }
+
+    def test_dsn_is_cached(self) -> None:
+        connection = PgConnection(user="user", host="localhost", dbname="db")
+        assert connection.get_dsn() is connection.get_dsn()
+
+    def test_invalid_parameters(self) -> None:
+        with pytest.raises(ValueError):
+            PgConnection(user="user", dbname="db", sslmode="always")
+        with pytest.raises(ValueError):
+            PgConnection(user="user", dbname="db", pooler="pgbouncer-session")
+        with pytest.raises(ValueError):
+            PgConnection(user="user", dbname="db", session={"work_mem = 1; --": "1MB"})
+        with pytest.raises(ValueError):
+            PgConnection(user="user", dbname="db", connect_timeout=-1)
+        with pytest.raises(TypeError):
+            PgConnection(user="user", dbname="db", keepalives_idle="30")  # type: ignore[arg-type]
@@ -1,11 +1,18 @@
 import asyncio
+import datetime
+import logging
+import os
+import sys
+from pathlib import Path
 from typing import Any, Callable, Iterator
 
 import pytest
 from applipy import Application, Config
-from applipy_inject.inject import with_names
+from applipy_inject.inject import Injector, with_names
+from psycopg2.errors import LockNotAvailable
 
 from applipy_pg import (
+    PgBackgroundMigration,
     PgClassNameMigration,
     PgConnection,
     PgMigration,
@@ -13,6 +20,10 @@ from applipy_pg import (
     PgPool,
 )
 from applipy_pg.migrations import find_migrations
+from applipy_pg.migrations.handle import MigrationsHandle
+from applipy_pg.migrations.manifest import find_migrations_with_manifest
+from applipy_pg.migrations.options import MigrationsOptions
+from applipy_pg.migrations.repository import Repository
 
 
 @pytest.fixture
@@ -125,6 +136,91 @@ class SomeSubject_20240201(PgClassNameMigration):
             )
 
 
+def _recording_migration(subject: str, version: str, events: list[str], fail: bool = False) -> PgMigration:
+    class _RecordingMigration(PgMigration):
+        async def migrate(self) -> None:
+            events.append(f"{subject}_{version} start")
+            await asyncio.sleep(0.1)
+            if fail:
+                raise RuntimeError(f"{subject}_{version} failed")
+            events.append(f"{subject}_{version} end")
+
+        def subject(self) -> str:
+            return subject
+
+        def version(self) -> str:
+            return version
+
+    return _RecordingMigration()
+
+
+def _create_type_migration(pool: PgPool) -> PgMigration:
+    class _CreateTypeMigration(PgMigration):
+        async def migrate(self) -> None:
+            async with pool.cursor() as cur:
+                await cur.execute("CREATE TYPE test_migrated_point AS (x int, label text);")
+
+        def subject(self) -> str:
+            return "Types"
+
+        def version(self) -> str:
+            return "1"
+
+    return _CreateTypeMigration()
+
+
+def _locking_migration(pool: PgPool, settings: list[tuple[str, str]]) -> PgMigration:
+    class _LockingMigration(PgMigration):
+        async def migrate(self) -> None:
+            async with pool.cursor() as cur:
+                await cur.execute(
+                    "SELECT current_setting('lock_timeout'), current_setting('statement_timeout');"
+                )
+                settings.append(await cur.fetchone())
+                await cur.execute("ALTER TABLE test_locked ADD COLUMN c int;")
+
+        def subject(self) -> str:
+            return "locking"
+
+        def version(self) -> str:
+            return "1"
+
+        def lock_timeout(self) -> float | None:
+            return 0.1
+
+    return _LockingMigration()
+
+
+def _backfill_migration(
+    pool: PgPool, chunks: list[str | None], fail_after_chunks: int | None = None
+) -> PgBackgroundMigration:
+    class _Backfill(PgBackgroundMigration):
+        async def migrate_chunk(self, after: str | None, batch_size: int) -> str | None:
+            if fail_after_chunks is not None and len(chunks) == fail_after_chunks:
+                raise RuntimeError("Simulated failure")
+            chunks.append(after)
+            async with pool.cursor() as cur:
+                await cur.execute(
+                    "UPDATE test_backfill SET processed = processed + 1 WHERE id IN ("
+                    " SELECT id FROM test_backfill WHERE id > %s ORDER BY id LIMIT %s"
+                    ") RETURNING id;",
+                    (int(after or 0), batch_size),
+                )
+                ids = [row[0] for row in await cur.fetchall()]
+            return str(max(ids)) if ids else None
+
+        def subject(self) -> str:
+            return "Backfill"
+
+        def version(self) -> str:
+            return "1"
+
+        def batch_size(self) -> int:
+            return 10
+
+    return _Backfill()
+
+
 @pytest.mark.asyncio
 class TestPgMigrationsModule:
     async def test_no_migrations(
@@ -350,6 +446,368 @@ class TestPgMigrationsModule:
         assert result[0] == ("20240101", "SomeSubject")
         assert result[1] == ("20240201", "SomeSubject")
 
+    async def test_concurrent_subjects_with_dependencies(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        events: list[str] = []
+        migrations = [
+            _recording_migration("A", "1", events),
+            _recording_migration("A", "2", events),
+            _recording_migration("B", "1", events),
+            _recording_migration("C", "1", events),
+        ]
+        sut = MigrationsHandle(
+            migrations,
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            MigrationsOptions(concurrency=2, subject_dependencies={"C": ["A"]}),
+        )
+
+        await sut.on_init()
+
+        assert events.index("B_1 start") < events.index("A_1 end")
+        assert events.index("A_1 end") < events.index("A_2 start")
+        assert events.index("A_2 end") < events.index("C_1 start")
+        async with migrations_conn.cursor() as cur:
+            await cur.execute(
+                "SELECT subject, version FROM applipy_pg_migrations_repository ORDER BY subject ASC;"
+            )
+            result = await cur.fetchall()
+        assert result == [("A", "2"), ("B", "1"), ("C", "1")]
+
+    async def test_failures_are_reported_per_subject(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        events: list[str] = []
+        migrations = [
+            _recording_migration("A", "1", events, fail=True),
+            _recording_migration("B", "1", events),
+            _recording_migration("C", "1", events),
+        ]
+        sut = MigrationsHandle(
+            migrations,
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            MigrationsOptions(concurrency=2, subject_dependencies={"C": ["A"]}),
+        )
+
+        with pytest.raises(ExceptionGroup) as exc_info:
+            await sut.on_init()
+
+        assert len(exc_info.value.exceptions) == 2
+        assert "B_1 end" in events
+        assert "C_1 start" not in events
+
+    async def test_single_failure_is_raised_as_is(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        events: list[str] = []
+        sut = MigrationsHandle(
+            [_recording_migration("A", "1", events, fail=True), _recording_migration("B", "1", events)],
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            MigrationsOptions(concurrency=2),
+        )
+
+        with pytest.raises(RuntimeError, match="A_1 failed"):
+            await sut.on_init()
+
+        assert "B_1 end" in events
+
+    async def test_sequential_migrations_stop_at_first_failure(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        events: list[str] = []
+        sut = MigrationsHandle(
+            [_recording_migration("A", "1", events, fail=True), _recording_migration("B", "1", events)],
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            None,
+        )
+
+        with pytest.raises(RuntimeError, match="A_1 failed"):
+            await sut.on_init()
+
+        assert "B_1 start" not in events
+
+    async def test_types_created_by_migrations_are_registered(self, database_test1: dict[str, Any]) -> None:
+        pool = PgPool(PgConnection(**database_test1, types=["test_migrated_point"]))
+        sut = MigrationsHandle(
+            [_create_type_migration(pool)],
+            Repository(pool, logging.getLogger(), None),
+            logging.getLogger(),
+            None,
+        )
+
+        await sut.on_init()
+
+        async with pool.cursor() as cur:
+            await cur.execute("SELECT ROW(1, 'a')::test_migrated_point;")
+            (point,) = await cur.fetchone()
+        assert (point.x, point.label) == (1, "a")
+        await pool.close()
+
+    async def test_pooled_migrations_connection_is_refused(self) -> None:
+        pool = PgPool(PgConnection(user="user", dbname="db", pooler="pgbouncer-transaction"))
+        with pytest.raises(ValueError):
+            Repository(pool, logging.getLogger(), None)
+
+    async def test_circular_subject_dependencies(self) -> None:
+        with pytest.raises(ValueError):
+            MigrationsHandle(
+                [_recording_migration("A", "1", []), _recording_migration("B", "1", [])],
+                Repository(PgPool(PgConnection(user="user", dbname="db")), logging.getLogger(), None),
+                logging.getLogger(),
+                MigrationsOptions(subject_dependencies={"A": ["B"], "B": ["A"]}),
+            )
+
+    async def test_latest_versions_loaded_from_existing_history(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        async with migrations_conn.cursor() as cur:
+            await cur.execute(
+                """
+CREATE TABLE applipy_pg_migrations_repository (
+    subject text not null,
+    version text not null,
+    utc_timestamp text not null,
+    CONSTRAINT subject_version PRIMARY KEY(subject, version)
+);
+INSERT INTO applipy_pg_migrations_repository (subject, version, utc_timestamp) VALUES
+('A', '20240201', '2024-02-01T00:00:00.000+00:00'),
+('A', '20240101', '2024-01-01T00:00:00.000+00:00'),
+('B', '1', '2024-01-01T00:00:00.000+00:00');
+"""
+            )
+        sut = Repository(migrations_conn, logging.getLogger(), None)
+
+        assert await sut.get_latest_versions() == {"A": "20240201", "B": "1"}
+
+        await sut.set_latest_versions({"A": "20240301", "C": "1"})
+
+        assert await sut.get_latest_versions() == {"A": "20240301", "B": "1", "C": "1"}
+        assert await sut.get_latest_version("A") == "20240301"
+        assert await sut.get_latest_version("D") is None
+
+    async def test_concurrent_handles_execute_migrations_once(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        events: list[str] = []
+        handles = [
+            MigrationsHandle(
+                [_recording_migration("A", "1", events), _recording_migration("B", "1", events)],
+                Repository(migrations_conn, logging.getLogger(), None),
+                logging.getLogger(),
+                MigrationsOptions(concurrency=2),
+            )
+            for _ in range(20)
+        ]
+
+        await asyncio.gather(*(handle.on_init() for handle in handles))
+
+        assert sorted(events) == ["A_1 end", "A_1 start", "B_1 end", "B_1 start"]
+        async with migrations_conn.cursor() as cur:
+            await cur.execute(
+                "SELECT subject, version FROM applipy_pg_migrations_repository ORDER BY subject ASC;"
+            )
+            result = await cur.fetchall()
+        assert result == [("A", "1"), ("B", "1")]
+
+    async def test_executions_are_recorded(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        repository = Repository(migrations_conn, logging.getLogger(), None)
+        sut = MigrationsHandle(
+            [
+                _recording_migration("A", "1", []),
+                _recording_migration("A", "2", []),
+                _recording_migration("B", "1", [], fail=True),
+            ],
+            repository,
+            logging.getLogger(),
+            MigrationsOptions(concurrency=2, app_version="1.2.3"),
+        )
+
+        with pytest.raises(RuntimeError):
+            await sut.on_init()
+
+        executions = await repository.get_slow_executions(0.0)
+        assert sorted((e.subject, e.version, e.succeeded) for e in executions) == [
+            ("A", "1", True),
+            ("A", "2", True),
+            ("B", "1", False),
+        ]
+        assert all(e.duration_seconds >= 0.1 for e in executions)
+        assert all(e.lock_wait_seconds == 0.0 for e in executions)
+        assert all(e.host and e.app_version == "1.2.3" and not e.background for e in executions)
+        assert await repository.get_slow_executions(10.0) == []
+
+        failed = await repository.get_failed_executions()
+        assert len(failed) == 1
+        assert failed[0].subject == "B"
+        assert failed[0].error == "RuntimeError: B_1 failed"
+        assert await repository.get_failed_executions(since=datetime.datetime.now(datetime.UTC)) == []
+
+    async def test_migrations_lock_timeout(
+        self,
+        migrations_conn: PgPool,
+    ) -> None:
+        repository = Repository(migrations_conn, logging.getLogger(), None)
+        sut = MigrationsHandle(
+            [_recording_migration("A", "1", [])],
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            MigrationsOptions(advisory_lock_timeout=0.2),
+        )
+
+        async with repository.lock():
+            with pytest.raises(LockNotAvailable):
+                await sut.on_init()
+
+        await sut.on_init()
+
+    async def test_migration_lock_timeout_is_retried(
+        self,
+        migrations_conn: PgPool,
+        output_conn: PgPool,
+    ) -> None:
+        async with output_conn.cursor() as cur:
+            await cur.execute("CREATE TABLE test_locked (id int);")
+        settings: list[tuple[str, str]] = []
+        repository = Repository(migrations_conn, logging.getLogger(), None)
+        sut = MigrationsHandle(
+            [_locking_migration(output_conn, settings)],
+            repository,
+            logging.getLogger(),
+            MigrationsOptions(statement_timeout=5, lock_retries=10, lock_retry_backoff=0.05),
+        )
+
+        async with output_conn.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("BEGIN; LOCK TABLE test_locked IN ACCESS SHARE MODE;")
+                migrate_task = asyncio.create_task(sut.on_init())
+                await asyncio.sleep(0.5)
+                await cur.execute("COMMIT;")
+        await migrate_task
+
+        assert len(settings) > 1
+        assert set(settings) == {("100ms", "5s")}
+        async with output_conn.cursor() as cur:
+            await cur.execute("SELECT current_setting('lock_timeout'), current_setting('statement_timeout');")
+            assert await cur.fetchone() == ("0", "0")
+            await cur.execute("SELECT c FROM test_locked;")
+        [execution] = await repository.get_slow_executions(0.0)
+        assert execution.succeeded
+        assert 0.0 < execution.lock_wait_seconds <= execution.duration_seconds
+
+    async def test_migration_lock_timeout_retries_are_limited(
+        self,
+        migrations_conn: PgPool,
+        output_conn: PgPool,
+    ) -> None:
+        async with output_conn.cursor() as cur:
+            await cur.execute("CREATE TABLE test_locked (id int);")
+        settings: list[tuple[str, str]] = []
+        sut = MigrationsHandle(
+            [_locking_migration(output_conn, settings)],
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            MigrationsOptions(lock_retries=2, lock_retry_backoff=0.01),
+        )
+
+        async with output_conn.connect() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("BEGIN; LOCK TABLE test_locked IN ACCESS SHARE MODE;")
+                with pytest.raises(LockNotAvailable):
+                    await sut.on_init()
+                await cur.execute("ROLLBACK;")
+
+        assert len(settings) == 3
+
+    async def test_background_migration_resumes_from_checkpoint(
+        self,
+        migrations_conn: PgPool,
+        output_conn: PgPool,
+    ) -> None:
+        async with output_conn.cursor() as cur:
+            await cur.execute(
+                "CREATE TABLE test_backfill (id int PRIMARY KEY, processed int NOT NULL DEFAULT 0);"
+                "INSERT INTO test_backfill (id) SELECT generate_series(1, 25);"
+            )
+        first_chunks: list[str | None] = []
+        first = MigrationsHandle(
+            [_backfill_migration(output_conn, first_chunks, fail_after_chunks=2)],
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            None,
+        )
+
+        await first.on_init()
+        assert first_chunks == []
+        await first.on_start()
+        assert first._background_task is not None
+        await first._background_task
+        await first.on_shutdown()
+
+        second_chunks: list[str | None] = []
+        second = MigrationsHandle(
+            [_backfill_migration(output_conn, second_chunks)],
+            Repository(migrations_conn, logging.getLogger(), None),
+            logging.getLogger(),
+            None,
+        )
+        await second.on_init()
+        await second.on_start()
+        assert second._background_task is not None
+        await second._background_task
+        await second.on_shutdown()
+
+        assert first_chunks == [None, "10"]
+        assert second_chunks == ["20", "25"]
+        async with output_conn.cursor() as cur:
+            await cur.execute("SELECT DISTINCT processed FROM test_backfill;")
+            assert await cur.fetchall() == [(1,)]
+        async with migrations_conn.cursor() as cur:
+            await cur.execute("SELECT subject, version FROM applipy_pg_migrations_state;")
+            assert await cur.fetchall() == [("Backfill", "1")]
+            await cur.execute("SELECT count(*) FROM applipy_pg_migrations_checkpoints;")
+            assert await cur.fetchone() == (0,)
+
+    async def test_concurrent_background_migrations_create_tables_once(
+        self,
+        migrations_conn: PgPool,
+        output_conn: PgPool,
+    ) -> None:
+        async with output_conn.cursor() as cur:
+            await cur.execute(
+                "CREATE TABLE test_backfill (id int PRIMARY KEY, processed int NOT NULL DEFAULT 0);"
+                "INSERT INTO test_backfill (id) SELECT generate_series(1, 25);"
+            )
+        chunks: list[str | None] = []
+        handles = [
+            MigrationsHandle(
+                [_backfill_migration(output_conn, chunks)],
+                Repository(migrations_conn, logging.getLogger(), None),
+                logging.getLogger(),
+                None,
+            )
+            for _ in range(10)
+        ]
+
+        await asyncio.gather(*(handle._run_background_migrations() for handle in handles))
+
+        assert chunks[0] is None
+        async with migrations_conn.cursor() as cur:
+            await cur.execute("SELECT subject, version FROM applipy_pg_migrations_state;")
+            assert await cur.fetchall() == [("Backfill", "1")]
+
     async def test_find_migrations(self) -> None:
         migrations = find_migrations("tests.integration")
         assert [m.__name__ for m in sorted(migrations, key=lambda c: c.__name__)] == [
@@ -358,3 +816,66 @@ class TestPgMigrationsModule:
             "_TestMigration1",
             "_TestMigration2",
         ]
+
+
+_MANIFEST_TEST_PACKAGE = "applipy_pg_manifest_test_migrations"
+_MANIFEST_TEST_MIGRATION = """
+from applipy_pg import PgClassNameMigration
+
+EXECUTED = []
+
+
+class Lazy_1(PgClassNameMigration):
+    async def migrate(self) -> None:
+        EXECUTED.append(self.version())
+"""
+
+
+@pytest.fixture
+def manifest_test_package(tmp_path: Path) -> Iterator[Path]:
+    package_path = tmp_path / _MANIFEST_TEST_PACKAGE
+    package_path.mkdir()
+    (package_path / "__init__.py").write_text("")
+    (package_path / "lazy_1.py").write_text(_MANIFEST_TEST_MIGRATION)
+    sys.path.insert(0, str(tmp_path))
+    yield package_path
+    sys.path.remove(str(tmp_path))
+    for module_name in list(sys.modules):
+        if module_name.startswith(_MANIFEST_TEST_PACKAGE):
+            del sys.modules[module_name]
+
+
+@pytest.mark.asyncio
+class TestMigrationsManifest:
+    async def test_find_migrations_with_manifest(self, manifest_test_package: Path, tmp_path: Path) -> None:
+        manifest_path = str(tmp_path / "manifest.json")
+        submodule_name = f"{_MANIFEST_TEST_PACKAGE}.lazy_1"
+
+        first = find_migrations_with_manifest([_MANIFEST_TEST_PACKAGE], manifest_path, Injector())
+        assert [m.__name__ for m in first if isinstance(m, type)] == ["Lazy_1"]
+        assert os.path.exists(manifest_path)
+
+        del sys.modules[submodule_name]
+        second = find_migrations_with_manifest([_MANIFEST_TEST_PACKAGE], manifest_path, Injector())
+        assert len(second) == 1
+        lazy_migration = second[0]
+        assert isinstance(lazy_migration, PgMigration)
+        assert (lazy_migration.subject(), lazy_migration.version()) == ("Lazy", "1")
+        assert submodule_name not in sys.modules
+
+        await lazy_migration.migrate()
+        assert sys.modules[submodule_name].EXECUTED == ["1"]
+
+        (manifest_test_package / "lazy_1.py").write_text(
+            _MANIFEST_TEST_MIGRATION + "\n\nclass Lazy_2(PgClassNameMigration):\n    pass\n"
+        )
+        del sys.modules[submodule_name]
+        third = find_migrations_with_manifest([_MANIFEST_TEST_PACKAGE], manifest_path, Injector())
+        assert sorted(m.__name__ for m in third if isinstance(m, type)) == ["Lazy_1", "Lazy_2"]
+
+    async def test_unwritable_manifest_is_ignored(self, manifest_test_package: Path, tmp_path: Path) -> None:
+        manifest_path = str(tmp_path / "missing_directory" / "manifest.json")
+
+        migrations = find_migrations_with_manifest([_MANIFEST_TEST_PACKAGE], manifest_path, Injector())
+        assert [m.__name__ for m in migrations if isinstance(m, type)] == ["Lazy_1"]
+        assert not os.path.exists(manifest_path)